@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''Times queries against a Document index and with match().
+
+Usage:
+
+    python benchmarks/document_queries.py
+
+Building the Document costs about as much as a couple of match() calls. After
+that, queries which end in a key or :nth-child test only look at the nodes
+which can match, so they should be several times faster than match(). If NumPy
+is installed, the vectorized engine is timed, too.
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jsonselect
+from jsonselect import columns
+
+
+SELECTORS = [
+    '.name',
+    '.records > * > .name',
+    '.tags > :last-child',
+    '.meta .x',
+    '.meta .x:expr(x > 100 && x < 2000)',
+    'object:has(.name)',
+    'string',
+]
+
+
+def document(n):
+    return {'records': [{'id': i, 'name': 'n%d' % i, 'tags': ['a', 'b', 'c'],
+                         'meta': {'x': i * 0.5, 'y': [1, 2, 3]}}
+                        for i in range(n)]}
+
+
+def best(fn):
+    return min(timeit.repeat(fn, number=1, repeat=3))
+
+
+def main():
+    obj = document(10000)
+    print('building the Document: %.1fms' % (
+        1000 * best(lambda: jsonselect.Document(obj))))
+    docs = [('Document', jsonselect.Document(obj))]
+    if columns.numpy is not None:
+        docs.append(('numpy', jsonselect.Document(obj, engine='numpy')))
+    print('%-36s%12s' % ('selector', 'match()') +
+          ''.join('%12s' % name for name, doc in docs))
+    for sel in SELECTORS:
+        sel = jsonselect.compile(sel)
+        times = [best(lambda: list(sel.match(obj)))]
+        for name, doc in docs:
+            times.append(best(lambda: list(doc.match(sel))))
+        print('%-36s' % sel.selector +
+              ''.join('%10.1fms' % (1000 * t) for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+'''Times match_many() against a separate match() call for each selector.
+
+Usage:
+
+    python benchmarks/many_selectors.py
+
+match_many() walks the document once, however many selectors there are, so it
+should pull further ahead of separate match() calls as their number grows.
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jsonselect
+
+
+def selectors(n):
+    # a mix of ids, types and child combinators, most of which share tests.
+    kinds = ['.f%d', '.rec > .f%d', 'string.f%d', '.meta .f%d',
+             'number.f%d, .tags > :first-child']
+    return dict(('s%d' % i, kinds[i % len(kinds)] % (i % 20))
+                for i in range(n))
+
+
+def document():
+    return {'rec': [dict([('f%d' % j, j if j % 2 else 'v%d' % j)
+                          for j in range(20)] +
+                         [('tags', ['a', 'b']), ('meta', {'f3': i})])
+                    for i in range(500)]}
+
+
+def time_separate(sels, obj):
+    compiled = [jsonselect.compile(s) for s in sels.values()]
+    return min(timeit.repeat(
+        lambda: [list(sel.match(obj)) for sel in compiled], number=1, repeat=3))
+
+
+def time_many(sels, obj):
+    return min(timeit.repeat(
+        lambda: list(jsonselect.match_many(sels, obj)), number=1, repeat=3))
+
+
+def main():
+    obj = document()
+    print('%10s%14s%14s' % ('selectors', 'match()', 'match_many()'))
+    for n in [1, 10, 30, 100, 200]:
+        sels = selectors(n)
+        print('%10d%12.1fms%12.1fms' % (n, 1000 * time_separate(sels, obj),
+                                        1000 * time_many(sels, obj)))
+
+
+if __name__ == '__main__':
+    main()
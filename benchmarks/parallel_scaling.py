@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+'''Times parallel_match() with increasing numbers of workers.
+
+Usage:
+
+    python benchmarks/parallel_scaling.py [features]
+
+The document is a GeoJSON FeatureCollection like tests/cli/basic.geo.json, with
+the given number of features (20000 by default). For each selector, the first
+row is match() in this process; the others are parallel_match(), including the
+time to start its pool. Throughput is in thousands of nodes per second, and
+should grow with the number of workers, up to the number of CPUs.
+'''
+
+import os
+import random
+import sys
+import timeit
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jsonselect
+
+
+SELECTORS = [
+    '.features > * > .properties > .name',
+    'number',
+    '.properties:has(.population:expr(x > 5000000)) .name',
+    '.coordinates > :nth-last-child(1)',
+]
+
+
+def document(n):
+    rnd = random.Random(0)
+    features = []
+    for i in range(n):
+        features.append(OrderedDict([
+            ('type', 'Feature'),
+            ('properties', OrderedDict([
+                ('name', 'Place %d' % i),
+                ('population', rnd.randint(0, 10 ** 7)),
+                ('wikipedia_url', 'https://en.wikipedia.org/wiki/%d' % i)])),
+            ('geometry', OrderedDict([
+                ('type', 'Polygon'),
+                ('coordinates', [[[rnd.uniform(-180, 180), rnd.uniform(-90, 90)]
+                                  for _ in range(rnd.randint(4, 40))]])]))]))
+    return OrderedDict([('type', 'FeatureCollection'), ('features', features)])
+
+
+def count_nodes(obj):
+    n = 1
+    if isinstance(obj, list):
+        for v in obj:
+            n += count_nodes(v)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            n += count_nodes(v)
+    return n
+
+
+def best(fn):
+    return min(timeit.repeat(fn, number=1, repeat=3))
+
+
+def main(args):
+    features = int(args[0]) if args else 20000
+    obj = document(features)
+    nodes = count_nodes(obj)
+    cpus = os.cpu_count() or 1
+    print('%d nodes, %d CPUs' % (nodes, cpus))
+    counts = sorted(set([2, 4, 8, cpus]))
+    print('%-56s %8s %10s %10s' % ('selector', 'workers', 'ms', 'knodes/s'))
+    for sel in SELECTORS:
+        sel = jsonselect.compile(sel)
+        runs = [('match()', lambda: list(sel.match(obj)))]
+        for n in counts:
+            runs.append((n, lambda n=n: list(jsonselect.parallel_match(
+                sel, obj, workers=n))))
+        for i, (workers, fn) in enumerate(runs):
+            t = best(fn)
+            print('%-56s %8s %10.1f %10.0f' % (
+                sel.selector if i == 0 else '', workers, 1000 * t,
+                nodes / t / 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''Times parse() on generated selectors of increasing length.
+
+Usage:
+
+    python benchmarks/parse_scaling.py
+
+Parsing should scale linearly with the length of the selector, so the
+microseconds-per-character column should stay roughly flat.
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from jsonselect import jsonselect
+
+
+def union_selector(n):
+    return ', '.join('.k%d > number:nth-child(2n+1)' % i for i in range(n))
+
+
+def expr_selector(n):
+    return ':expr(' + ' && '.join('x != %d' % i for i in range(n)) + ')'
+
+
+def has_selector(n):
+    return 'object:has(' + ', '.join('.k%d string' % i for i in range(n)) + ')'
+
+
+def time_parse(sel):
+    runs = max(1, 20000 // len(sel))
+    t = min(timeit.repeat(lambda: jsonselect.parse(sel), number=runs, repeat=3))
+    return t / runs
+
+
+def main():
+    for name, gen in [('union', union_selector),
+                      ('expr', expr_selector),
+                      ('has', has_selector)]:
+        print('%-6s %8s %12s %12s' % (name, 'chars', 'ms/parse', 'us/char'))
+        for n in [10, 100, 1000, 4000]:
+            sel = gen(n)
+            t = time_parse(sel)
+            print('%-6s %8d %12.3f %12.3f' % (
+                '', len(sel), 1000 * t, 1e6 * t / len(sel)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+'''Runs all of the benchmarks and writes the results as JSON.
+
+Usage:
+
+    python benchmarks/suite.py [--quick] [-o results.json]
+    python benchmarks/suite.py --compare before.json after.json
+
+There are four parts:
+
+    micro: lex(), parse(), exprParse() and exprEval() on typical inputs.
+    match: match() for each selector in the conformance tests (tests/spec and
+           tests/level_4), against a scaled-up copy of its input document.
+    cli: cli.run() on generated GeoJSON like tests/cli/basic.geo.json.
+    memory: the peak memory allocated by match(), Document() and cli.run().
+
+Each timing is the best of a few runs, in seconds per call. Nothing needs to
+be downloaded, but the tests/spec submodule is only used if it's been checked
+out. --quick uses smaller inputs, for a rough check.
+
+--compare prints the ratio of each timing in the second file to the first.
+'''
+
+from __future__ import print_function
+
+import copy
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import cli
+import jsonselect
+from jsonselect import jsonselect as engine
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+MICRO_SELECTORS = [
+    '.name',
+    '.features > * > .properties .name',
+    'object:has(.k:val("x")) ~ number:nth-child(2n+1)',
+    ':root > .a, .b:first-child, string:expr(x ^= "p")',
+]
+
+MICRO_EXPRS = [
+    'x > 100)',
+    'x > 1 && x < 5 || x = 10)',
+    'x ^= "abc" && (x $= "z" || x *= "q"))',
+]
+
+CLI_ACTIONS = [
+    ['.name'],
+    ['-v', '.coordinates'],
+    ['-k', '.features > * > .properties'],
+    ['-k', '.features > *:has(:contains("Aruba"))', '-v', '.coordinates'],
+    ['-k', '.properties', '-v', '.wikipedia_url', '.name'],
+]
+
+
+def best(fn, number=1, repeat=3):
+    '''Returns the best time for a call to fn, in seconds.'''
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def calls_per_run(fn, target=0.05):
+    '''Picks how many calls of fn to time together, so that each run is long
+    enough to measure.'''
+    n = 1
+    while True:
+        t = timeit.timeit(fn, number=n)
+        if t >= target or n >= 1000000:
+            return n
+        n *= 10
+
+
+def micro():
+    results = OrderedDict()
+
+    def add(name, fn):
+        n = calls_per_run(fn)
+        results[name] = best(fn, number=n)
+
+    for i, sel in enumerate(MICRO_SELECTORS):
+        def lex_all(sel=sel):
+            off = 0
+            while True:
+                tok = engine.lex(sel, off)
+                if not tok:
+                    break
+                off = tok[0]
+        add('lex %d' % i, lex_all)
+        add('parse %d' % i, lambda sel=sel: engine.parse(sel))
+    for i, expr in enumerate(MICRO_EXPRS):
+        parsed = engine.exprParse(expr, 0)[1]
+        add('exprParse %d' % i, lambda expr=expr: engine.exprParse(expr, 0))
+        for x in [5, 'abcz']:
+            add('exprEval %d %r' % (i, x),
+                lambda parsed=parsed, x=x: engine.exprEval(parsed, x))
+    return results
+
+
+def count_nodes(obj):
+    n = 1
+    if isinstance(obj, list):
+        for v in obj:
+            n += count_nodes(v)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            n += count_nodes(v)
+    return n
+
+
+def has_array(obj):
+    if isinstance(obj, list):
+        return True
+    if isinstance(obj, dict):
+        return any(has_array(v) for v in obj.values())
+    return False
+
+
+def scale(obj, factor, root=True):
+    '''Returns a copy of obj which is about factor times bigger.
+
+    The outermost arrays are repeated factor times. If there aren't any, the
+    root object's members are copied under new keys instead. Either way, the
+    document keeps its shape, so the selectors still match.
+    '''
+    if isinstance(obj, list):
+        return [copy.deepcopy(v) for _ in range(factor) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if has_array(obj):
+        return OrderedDict((k, scale(v, factor, False)) for k, v in obj.items())
+    if not root:
+        return copy.deepcopy(obj)
+    out = OrderedDict(obj)
+    for i in range(1, factor):
+        for k, v in obj.items():
+            out['%s~%d' % (k, i)] = copy.deepcopy(v)
+    return out
+
+
+def conformance_tests():
+    '''Yields (name, document, selector) for the conformance tests.'''
+    paths = sorted(glob.glob(os.path.join(ROOT, 'tests', 'spec', 'level_*')))
+    paths.append(os.path.join(ROOT, 'tests', 'level_4'))
+    for path in paths:
+        for json_path in sorted(glob.glob(os.path.join(path, '*.json'))):
+            doc = json.load(open(json_path), object_pairs_hook=OrderedDict)
+            for sel_path in sorted(glob.glob(
+                    json_path.replace('.json', '_*.selector'))):
+                name = os.path.relpath(sel_path, os.path.join(ROOT, 'tests'))
+                yield name, doc, open(sel_path).read().strip()
+
+
+def match(nodes):
+    results = OrderedDict()
+    scaled = {}
+    for name, doc, selector in conformance_tests():
+        try:
+            sel = jsonselect.compile(selector)
+        except jsonselect.JsonSelectError:
+            continue  # a test of error handling.
+        key = id(doc)
+        if key not in scaled:
+            factor = max(1, nodes // count_nodes(doc))
+            scaled[key] = scale(doc, factor)
+        obj = scaled[key]
+        try:
+            results[name] = best(lambda: list(sel.match(obj)))
+        except jsonselect.JsonSelectError:
+            pass
+    return results
+
+
+def geojson(features):
+    '''Returns a FeatureCollection like tests/cli/basic.geo.json.'''
+    rnd = random.Random(0)
+    template = json.load(open(os.path.join(ROOT, 'tests', 'cli',
+                                           'basic.geo.json')),
+                         object_pairs_hook=OrderedDict)
+    out = []
+    for i in range(features):
+        f = copy.deepcopy(template['features'][i % len(template['features'])])
+        f['geometry']['coordinates'] = [
+            [[rnd.uniform(-180, 180), rnd.uniform(-90, 90)]
+             for _ in range(rnd.randint(4, 40))]]
+        f['properties']['name'] = 'Place %d' % i
+        f['properties']['population'] = rnd.randint(0, 10 ** 7)
+        out.append(f)
+    return OrderedDict([('type', 'FeatureCollection'), ('features', out)])
+
+
+class NullWriter(object):
+    def write(self, s):
+        pass
+
+
+def cli_runs(path):
+    results = OrderedDict()
+    for args in CLI_ACTIONS:
+        results[' '.join(args)] = best(
+            lambda: cli.run(list(args) + [path], NullWriter()))
+    return results
+
+
+def peak_memory(fn):
+    '''Returns the peak memory allocated while fn runs, in bytes.'''
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def memory(obj, path):
+    if tracemalloc is None:
+        return None
+    sel = jsonselect.compile('.features > * > .properties .name')
+    results = OrderedDict()
+    results['match()'] = peak_memory(lambda: list(sel.match(obj)))
+    results['Document()'] = peak_memory(lambda: jsonselect.Document(obj))
+    for args in CLI_ACTIONS[:2]:
+        results['cli ' + ' '.join(args)] = peak_memory(
+            lambda: cli.run(list(args) + [path], NullWriter()))
+    return results
+
+
+def commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                      stderr=subprocess.STDOUT)
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(quick=False):
+    nodes = 2000 if quick else 20000
+    features = 200 if quick else 5000
+    results = OrderedDict()
+    results['meta'] = OrderedDict([
+        ('commit', commit()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('quick', quick),
+    ])
+
+    sys.stderr.write('micro...\n')
+    results['micro'] = micro()
+    sys.stderr.write('match...\n')
+    results['match'] = match(nodes)
+
+    sys.stderr.write('cli...\n')
+    obj = geojson(features)
+    f = tempfile.NamedTemporaryFile('w', suffix='.geo.json', delete=False)
+    try:
+        json.dump(obj, f)
+        f.close()
+        results['cli'] = cli_runs(f.name)
+        sys.stderr.write('memory...\n')
+        results['memory'] = memory(obj, f.name)
+    finally:
+        os.unlink(f.name)
+    return results
+
+
+def compare(before, after):
+    '''Prints the ratio of each result in after to the one in before.'''
+    for part in ['micro', 'match', 'cli', 'memory']:
+        a, b = before.get(part) or {}, after.get(part) or {}
+        names = [name for name in b if name in a and a[name]]
+        if not names:
+            continue
+        print(part)
+        for name in names:
+            print('  %-60s %8.2fx' % (name[:60], float(b[name]) / a[name]))
+
+
+def main(args):
+    if args[:1] == ['--compare']:
+        compare(json.load(open(args[1])), json.load(open(args[2])))
+        return
+    quick = '--quick' in args
+    path = args[args.index('-o') + 1] if '-o' in args else None
+    results = run(quick)
+    text = json.dumps(results, indent=2)
+    if path:
+        open(path, 'w').write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
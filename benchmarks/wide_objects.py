@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''Times child id selectors against objects with many keys.
+
+Usage:
+
+    python benchmarks/wide_objects.py
+
+Selectors like ":root > .foo" look their keys up directly, so their time
+should stay flat as the object gets wider. ":root > *" has to visit every
+child and is shown for comparison.
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jsonselect
+
+
+SELECTORS = [
+    ':root > .k7',
+    ':root > .k7, :root > .k3',
+    '.k7 > .x',
+    ':root > *',
+]
+
+
+def wide_object(n):
+    return dict(('k%d' % i, {'x': i}) for i in range(n))
+
+
+def time_match(sel, obj):
+    sel = jsonselect.compile(sel)
+    runs = 20
+    t = min(timeit.repeat(lambda: list(sel.match(obj)), number=runs, repeat=3))
+    return t / runs
+
+
+def main():
+    widths = [1000, 10000, 100000]
+    print('%-28s' % 'selector' + ''.join('%12s' % ('%d keys' % n)
+                                          for n in widths))
+    objs = [wide_object(n) for n in widths]
+    for sel in SELECTORS:
+        print('%-28s' % sel + ''.join('%10.3fms' % (1000 * time_match(sel, obj))
+                                      for obj in objs))
+
+
+if __name__ == '__main__':
+    main()
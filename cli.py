@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import codecs
+import errno
 import json
+import multiprocessing
+import numbers
+import os
 import sys
 import time
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from itertools import islice
 
 from jsonselect import jsonselect
+from jsonselect.document import Document
 
 DEBUG = False
 
@@ -15,20 +22,6 @@ KEEP = 1
 DELETE = 2
 
 
-def selector_to_ids(selector, obj, mode):
-    def bail_on_match(obj, matches):
-        return matches
-
-    bail_fn = None
-    if mode == DELETE:
-        # There's no point in continuing a search below a node which will be
-        # marked for deletion.
-        bail_fn = bail_on_match
-
-    matches = jsonselect.match(selector, obj, bailout_fn=bail_fn)
-    return [id(node) for node in matches]
-
-
 def filter_object(obj, marks, presumption=DELETE):
     '''Filter down obj based on marks, presuming keys should be kept/deleted.
 
@@ -63,7 +56,7 @@ def filter_object(obj, marks, presumption=DELETE):
 
 
 def usage():
-    print ('''%s [selector] [-v exclude_selector]
+    print ('''%s [--ndjson [--jobs N] [--ordered]] [--output pretty|compact|ndjson] [--stats] [selector] [-v exclude_selector] file
 
 ...
 ''')
@@ -95,87 +88,539 @@ def maybe_round(f):
         return repr(f)
 
 
+PRETTY = 'pretty'
+COMPACT = 'compact'
+NDJSON = 'ndjson'
+
+# The number of characters the JSONWriter collects before writing them out.
+BUFFER_SIZE = 64 * 1024
+
+_encode_string = json.encoder.encode_basestring
+_INFINITY = float('inf')
+
+
+def _float_repr(f):
+    # Note: it's unclear whether rounding these floats is a good idea, but it's
+    # what jq does, so we do it too to simplify comparisons.
+    if f != f:
+        return 'NaN'
+    elif f == _INFINITY:
+        return 'Infinity'
+    elif f == -_INFINITY:
+        return '-Infinity'
+    return maybe_round(f)
+
+
+class JSONWriter(object):
+    def __init__(self, write, mode=PRETTY, buffer_size=BUFFER_SIZE):
+        '''Encodes JSON values, passing the text to write() in pieces.
+
+        Unlike json.dumps(), this doesn't build the whole text of a value before
+        any of it is written: at most about buffer_size characters are held at
+        once. Floats with integral values are written as integers.
+
+        Args:
+            write: Called with each piece of the output, e.g. sys.stdout.write.
+            mode: PRETTY (indented, like json.dumps(..., indent=2)), COMPACT
+                  (one line per value) or NDJSON (one line per value, with no
+                  spaces at all).
+        '''
+        if mode not in (PRETTY, COMPACT, NDJSON):
+            raise ValueError('Unknown output mode: %s' % mode)
+        self._write = write
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self._parts = []
+        self._size = 0
+        if mode == NDJSON:
+            self._comma, self._colon = ',', ':'
+        else:
+            self._comma, self._colon = ', ', ': '
+
+    def write(self, o):
+        '''Writes a value, followed by a newline.'''
+        self._encode(o, '\n')
+        self._put('\n')
+
+    def flush(self):
+        '''Passes along any output which is still buffered.'''
+        if self._parts:
+            self._write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+
+    def _put(self, s):
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def _encode(self, o, newline):
+        if isinstance(o, jsonselect.stringtype):
+            self._put(_encode_string(o))
+        elif o is None:
+            self._put('null')
+        elif o is True:
+            self._put('true')
+        elif o is False:
+            self._put('false')
+        elif isinstance(o, float):
+            self._put(_float_repr(o))
+        elif isinstance(o, numbers.Integral):
+            self._put(str(o))
+        elif isinstance(o, dict):
+            if not o:
+                self._put('{}')
+                return
+            self._container(o, '{', '}', newline)
+        elif isinstance(o, (list, tuple)):
+            if not o:
+                self._put('[]')
+                return
+            self._container(o, '[', ']', newline)
+        else:
+            raise TypeError('%r is not JSON serializable' % (o,))
+
+    def _container(self, o, start, end, newline):
+        if self.mode == PRETTY:
+            inner = newline + '  '
+            sep = ',' + inner
+            self._put(start + inner)
+        else:
+            inner = newline
+            sep = self._comma
+            self._put(start)
+        first = True
+        if start == '{':
+            for k, v in jsonselect.iteritems(o):
+                if not first:
+                    self._put(sep)
+                first = False
+                self._put(_encode_string(k) + self._colon)
+                self._encode(v, inner)
+        else:
+            for v in o:
+                if not first:
+                    self._put(sep)
+                first = False
+                self._encode(v, inner)
+        self._put(newline + end if self.mode == PRETTY else end)
+
+
 def apply_filter(objs, selector, mode):
     '''Apply selector to transform each object in objs.
 
-    This operates in-place on objs. Empty objects are removed from the list.
+    This operates in-place on objs.
 
     Args:
         mode: either KEEP (to keep selected items & their ancestors) or DELETE
               (to delete selected items and their children).
     '''
-    indices_to_delete = []
-    presumption = DELETE if mode == KEEP else KEEP
-    for i, obj in enumerate(objs):
-        timer.log('Applying selector: %s' % selector)
-        marks = {k: mode for k in selector_to_ids(selector, obj, mode)}
-        timer.log('done applying selector')
-        timer.log('filtering object...')
-        filter_object(obj, marks, presumption=presumption)
-        timer.log('done filtering')
-        if obj is None:
-            indices_to_delete.append(i)
+    objs[:] = run_pass(objs, [('-k' if mode == KEEP else '-v', selector)])
 
-    for index in reversed(indices_to_delete):
-        del objs[index]
 
-
-def apply_selector(objs, selector):
+def apply_selector(objs, selector, stats=None):
     '''Returns a list of objects which match the selector in any of objs.'''
     out = []
+    selector = jsonselect.compile(selector)
     for obj in objs:
         timer.log('Applying selector: %s' % selector)
-        out += list(jsonselect.match(selector, objs))
+        out += list(jsonselect.match(selector, obj, stats=stats))
         timer.log('done applying selector')
     return out
 
 
-timer = Timer()
+def apply_actions(objs, actions, stats=None):
+    '''Applies a list of (action, selector) pairs to objs, returning the result.
 
-def run(args):
-    global DEBUG
-    path = args.pop()  # TODO: allow stdin
-    actions = args
+    If stats (a jsonselect.Stats) is given, the work done matching the
+    selectors is counted in it.
+    '''
+    return list(iter_actions(objs, actions, stats))
+
+
+def iter_actions(objs, actions, stats=None):
+    '''Like apply_actions(), but yields the results one at a time.
+
+    If the last action is a select which needs a pass of its own, its matches
+    are yielded as they're found.
+    '''
+    return iter_passes(objs, plan_actions(actions), stats)
+
+
+def iter_passes(objs, passes, stats=None):
+    '''Like iter_actions(), but for actions which plan_actions() has already
+    grouped into passes.'''
+    last = passes[-1] if passes else []
+    for actions in passes[:-1]:
+        objs = run_pass(objs, actions, stats)
+    if len(last) == 1 and last[0][0] == '':
+        selector = jsonselect.compile(last[0][1])
+        for obj in objs:
+            for v in selector.match(obj, stats=stats):
+                yield v
+    else:
+        for o in (run_pass(objs, last, stats) if last else objs):
+            yield o
 
-    if actions and actions[0] == '--debug':
-        DEBUG = True
-        del actions[0]
 
-    timer.log('Loading JSON...')
-    objs = [json.load(open(path), object_pairs_hook=OrderedDict)]
-    timer.log('done loading JSON')
+def is_local(selector):
+    '''Is whether a node matches selector decided by the types, keys and values
+    of the node and its ancestors alone?
 
-    action_mode = None
+    Filtering doesn't change which of the remaining nodes such a selector
+    matches, so it can be matched before the filters have been applied.
+    Selectors with :has(), ~, :nth-child or expressions whose truth depends on
+    the contents of a container are not local.
+    '''
+    states = jsonselect.compile(selector)._states
+    stack = list(states.states) if states else []
+    while stack:
+        st = stack.pop()
+        simple = st.simple
+        if (st.sibs or st.tail is not None or simple.has or
+                simple.nth is not None or
+                (simple.expr is not None and not _is_local_expr(simple.source))):
+            return False
+        if st.next is not None:
+            stack.append(st.next)
+    return True
+
+
+def _is_local_expr(expr):
+    '''Is a parsed expression's truth the same for any array or object?'''
+    if not isinstance(expr, list):
+        return expr is not jsonselect.Undefined
+    lhs, op, rhs = expr
+    if op == '&&' or op == '||':
+        return _is_local_expr(lhs) and _is_local_expr(rhs)
+    # containers never compare equal to (or less than...) a literal.
+    if op in ('=', '!=', '<', '<=', '>', '>=', '$=', '^=', '*='):
+        if lhs is jsonselect.Undefined:
+            return not isinstance(rhs, list) and rhs is not jsonselect.Undefined
+        if rhs is jsonselect.Undefined:
+            return not isinstance(lhs, list)
+    return False
+
+
+def plan_actions(actions):
+    '''Groups a list of (action, selector) pairs into passes for run_pass().
+
+    A pass is a run of -k/-v filters, optionally followed by a select. Every
+    selector after the first in a pass is local (see is_local()), so they can
+    all be matched against the unfiltered object.
+    '''
+    passes = []
+    for action, selector in actions:
+        if (passes and passes[-1][-1][0] != '' and is_local(selector)):
+            passes[-1].append((action, selector))
+        else:
+            passes.append([(action, selector)])
+    return passes
 
-    while actions:
-        action = actions[0]
+
+def run_pass(objs, actions, stats=None):
+    '''Applies a pass from plan_actions() to each of objs, returning the result.
+
+    Each object is indexed once, all the selectors are matched against the
+    index, and then each node's fate under the filters is worked out in a
+    single sweep, before the object is pruned in place.
+    '''
+    select = None
+    if actions[-1][0] == '':
+        select = actions[-1][1]
+        actions = actions[:-1]
+    if not actions:
+        return apply_selector(objs, select, stats)
+
+    out = []
+    for obj in objs:
+        timer.log('Indexing object...')
+        doc = Document(obj)
+        timer.log('done indexing')
+        steps = []
+        for action, selector in actions:
+            timer.log('Applying selector: %s' % selector)
+            steps.append((KEEP if action == '-k' else DELETE,
+                          doc.numbers(selector, stats=stats)))
+            timer.log('done applying selector')
+        selected = None
+        if select is not None:
+            timer.log('Applying selector: %s' % select)
+            selected = doc.numbers(select, stats=stats)
+            timer.log('done applying selector')
+
+        timer.log('filtering object...')
+        alive = survivors(doc, steps)
+        prune(doc, alive)
+        timer.log('done filtering')
+        if selected is None:
+            out.append(obj)
+        else:
+            out += [doc.nodes[i] for i in selected if alive[i]]
+    return out
+
+
+def survivors(doc, steps):
+    '''Works out which nodes of a Document survive a series of filters.
+
+    This gives the same result as running filter_object() for each step in
+    turn, with the marks for the nodes that step's selector matched.
+
+    Args:
+        doc: The Document to filter.
+        steps: A list of (KEEP or DELETE, numbers of the matched nodes).
+    Returns:
+        A list of bools, indexed by node number.
+    '''
+    n = len(doc.nodes)
+    root = n - 1
+    parents = doc.parents
+    # Bit j of covered[i] is set if step j marked node i or one of its
+    # ancestors. The root can't be filtered out, so its own marks don't count.
+    # A knockout doesn't look below the nodes it matches, though, so if it
+    # matches the root, then it doesn't mark anything.
+    covered = [0] * n
+    for j, (mode, matches) in enumerate(steps):
+        if mode == DELETE and matches and matches[-1] == root:
+            continue
+        for i in matches:
+            covered[i] |= 1 << j
+    covered[root] = 0
+    for i in range(root - 1, -1, -1):
+        covered[i] |= covered[parents[i]]
+
+    # A node gets through a knockout if it isn't covered, and through a keep
+    # if it's covered or some of its children got through. It survives the
+    # steps up to the first one it doesn't get through.
+    # Bit j of kept[i] is set if any of node i's children survive step j.
+    deletes = sum(1 << j for j, (mode, _) in enumerate(steps)
+                  if mode == DELETE)
+    keeps = sum(1 << j for j, (mode, _) in enumerate(steps) if mode == KEEP)
+    every = deletes | keeps
+    kept = [0] * n
+    alive = [True] * n
+    for i in range(root):
+        c = covered[i]
+        passed = (~c & deletes) | ((c | kept[i]) & keeps)
+        bits = (passed ^ (passed + 1)) >> 1  # the run of low bits that are set
+        alive[i] = bits == every
+        kept[parents[i]] |= bits
+    return alive
+
+
+def prune(doc, alive):
+    '''Deletes the nodes of a Document which didn't survive, in place.'''
+    for p, kids in enumerate(doc.children):
+        if not kids or not alive[p]:
+            continue
+        node = doc.nodes[p]
+        dead = [kid for kid in kids if not alive[kid]]
+        if not dead:
+            continue
+        if doc.codes[p] == jsonselect._ARRAY:
+            node[:] = [doc.nodes[kid] for kid in kids if alive[kid]]
+        else:
+            for kid in dead:
+                del node[doc.keys[kid]]
+
+
+def parse_actions(args):
+    '''Converts command line arguments to a list of (action, selector) pairs.'''
+    actions = []
+    while args:
+        action = args[0]
+        del args[0]
+        if action == '-k' or action == '-v':
+            actions.append((action, args[0]))
+            del args[0]
+        elif action == '.':
+            continue
+        else:
+            actions.append(('', action))
+    return actions
+
+
+# The number of lines which are handed to a worker at once in --ndjson mode.
+NDJSON_CHUNK_LINES = 1000
+
+
+def ndjson_chunks(f, size=NDJSON_CHUNK_LINES):
+    '''Yields (line number, lines) for successive chunks of the lines in f.'''
+    lineno = 1
+    while True:
+        lines = list(islice(f, size))
+        if not lines:
+            return
+        yield lineno, lines
+        lineno += len(lines)
+
+
+def apply_actions_ndjson(chunk, actions, mode=NDJSON, stats=None):
+    '''Applies actions to each record in a chunk of NDJSON lines.
+
+    Returns the output records as a string, written in the given mode.
+    '''
+    lineno, lines = chunk
+    passes = plan_actions(actions)
+    out = []
+    writer = JSONWriter(out.append, mode)
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line, object_pairs_hook=OrderedDict)
+        except ValueError as e:
+            raise ValueError('line %d: %s' % (lineno + i, e))
+        for o in iter_passes([obj], passes, stats):
+            writer.write(o)
+    writer.flush()
+    return ''.join(out)
+
+
+def write_done(pending, out, ordered):
+    '''Writes out at least one finished chunk, waiting for one if need be.'''
+    if ordered:
+        out.write(pending.popleft().get())
+        return
+    done = [r for r in pending if r.ready()]
+    if not done:
+        pending[0].wait()
+        done = [pending[0]]
+    for r in done:
+        pending.remove(r)
+        out.write(r.get())
+
+
+def run_ndjson(f, actions, out, jobs=1, ordered=False, mode=NDJSON,
+               stats=None):
+    '''Applies actions to each line of f, writing the results to out.
+
+    With jobs > 1, chunks of lines are processed by a pool of worker processes.
+    Their output is written as each chunk finishes, or in the order of the
+    input if ordered is set. stats can only be collected with jobs == 1.
+    '''
+    if stats is not None and jobs != 1:
+        raise ValueError('--stats only works with --jobs 1')
+    for _, selector in actions:
+        jsonselect.compile(selector)  # report syntax errors up front.
+    chunks = ndjson_chunks(f)
+    if jobs == 1:
+        for chunk in chunks:
+            out.write(apply_actions_ndjson(chunk, actions, mode, stats))
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Only a few chunks per worker are read ahead, so that memory use
+        # doesn't grow with the size of the input.
+        pending = deque()
+        for chunk in chunks:
+            pending.append(
+                pool.apply_async(apply_actions_ndjson, (chunk, actions, mode)))
+            if len(pending) >= 2 * jobs:
+                write_done(pending, out, ordered)
+        while pending:
+            write_done(pending, out, ordered)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+timer = Timer()
+
+def run(args, out=None):
+    '''Runs the command line in args.
+
+    The last argument is the input file, or "-" for stdin. In --ndjson mode,
+    each line of the input is a JSON record.
+
+    The output is written to out as it's produced. If out is None, it's
+    returned as a string instead.
+    '''
+    global DEBUG
+    path = args.pop()
+    actions = args
+
+    ndjson = False
+    ordered = False
+    jobs = 1
+    mode = None
+    stats = None
+    while actions and actions[0].startswith('--'):
+        option = actions[0]
         del actions[0]
-        mode = None
-        if action == '-k':
-            selector = actions[0]
+        if option == '--debug':
+            DEBUG = True
+        elif option == '--ndjson':
+            ndjson = True
+        elif option == '--ordered':
+            ordered = True
+        elif option == '--jobs':
+            # --jobs 0 uses one process per CPU.
+            jobs = int(actions[0]) or multiprocessing.cpu_count()
             del actions[0]
-            apply_filter(objs, selector, KEEP)
-        elif action == '-v':
-            selector = actions[0]
+        elif option == '--output':
+            mode = actions[0]
             del actions[0]
-            apply_filter(objs, selector, DELETE)
-        elif action == '.':
-            continue
+        elif option == '--stats':
+            # count the work done in matching, and write it to stderr.
+            stats = jsonselect.Stats()
         else:
-            objs = apply_selector(objs, action)
+            raise ValueError('Unknown option: %s' % option)
 
-    def json_dump(o):
-        return json.dumps(o, indent=2, separators=(',', ': '), ensure_ascii=False)
+    actions = parse_actions(actions)
 
-    # Note: it's unclear whether rounding these floats is a good idea, but it's
-    # what jq does, so we do it too to simplify comparisons.
-    save = json.encoder.FLOAT_REPR
-    json.encoder.FLOAT_REPR = maybe_round
-    r = '\n'.join([json_dump(o) for o in objs]) + '\n'
-    json.encoder.FLOAT_REPR = save
-    return r
+    parts = None
+    if out is None:
+        parts = []
+        write = parts.append
+    else:
+        write = out.write
+
+    def process(f):
+        if ndjson:
+            run_ndjson(f, actions, out or _Appender(parts), jobs=jobs,
+                       ordered=ordered, mode=mode or NDJSON, stats=stats)
+            return
+        writer = JSONWriter(write, mode or PRETTY)
+        timer.log('Loading JSON...')
+        objs = [json.load(f, object_pairs_hook=OrderedDict)]
+        timer.log('done loading JSON')
+
+        for o in iter_actions(objs, actions, stats):
+            writer.write(o)
+        writer.flush()
+
+    if path == '-':
+        process(sys.stdin)
+    else:
+        with open(path) as f:
+            process(f)
+
+    if stats is not None:
+        sys.stderr.write(json.dumps(stats.as_dict(), indent=2) + '\n')
+
+    if parts is not None:
+        return ''.join(parts)
+
+
+class _Appender(object):
+    '''A file-like object which collects what's written to it in a list.'''
+
+    def __init__(self, parts):
+        self.write = parts.append
 
 
 if __name__ == '__main__':
-    print (run(sys.argv[1:]).encode('utf8'))
+    # write UTF-8, whatever the locale.
+    out = codecs.getwriter('utf8')(getattr(sys.stdout, 'buffer', sys.stdout))
+    try:
+        run(sys.argv[1:], out)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        # the reader went away, e.g. "| head". That's fine, but don't let
+        # Python complain when it flushes stdout on the way out.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
     timer.log('done printing')
@@ -1,4 +1,9 @@
 __title__ = 'pyjsonselect'
 __author__ = 'Dan Vanderkam'
 
-from .jsonselect import match
+from .jsonselect import (__version__, match, match_many, exists, count, first,
+                         compile, Selector, Stats, cache_info, cache_clear,
+                         set_cache_size, cache_save, cache_load)
+from .stream import match_stream, exists_stream, count_stream, first_stream
+from .document import Document
+from .parallel import parallel_match
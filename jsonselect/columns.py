@@ -0,0 +1,253 @@
+'''Vectorized matching over the nodes of a Document, using NumPy.
+
+    doc = jsonselect.Document(obj, engine='numpy')
+    for v in doc.match('.records > * > .price:expr(x > 100)'):
+        ...
+
+The Document's nodes are laid out as columns (type code, interned key, parent,
+position, siblings count, extent of the subtree and numeric value), and each
+fragment of a selector is evaluated for all of the nodes at once:
+
+    - type, id and :nth-child tests are comparisons against the columns,
+    - :expr() comparisons between x and a number (joined by && and ||) are
+      comparisons against the numeric values,
+    - "A > B" follows the parent column from A's matches, and "A B" marks the
+      subtrees below them (in post-order, a subtree is a run of nodes).
+
+:has(), string comparisons and other expressions are still tested one node at a
+time, but only against the nodes which pass the other tests.
+
+NumPy is optional; without it, Documents use the pure-Python engine.
+'''
+
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .jsonselect import _Context, _jsTypeof, Undefined, _NUMBER
+
+# The comparisons between x and a number which are evaluated as array
+# operations. Like the scalar versions, they only hold for numbers.
+_orderings = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+
+
+def _isNumber(v):
+    return not isinstance(v, list) and v is not Undefined and \
+        _jsTypeof(v) == 'number'
+
+
+class Columns(object):
+    '''The nodes of a Document as NumPy arrays, indexed by node number.'''
+
+    def __init__(self, doc):
+        n = len(doc.nodes)
+        self.doc = doc
+        self.n = n
+        self.codes = numpy.array(doc.codes, dtype=numpy.int8)
+        self.parents = numpy.array(
+            [-1 if p is None else p for p in doc.parents], dtype=numpy.int64)
+        self.keyids = dict((k, i) for i, k in enumerate(doc.by_key))
+        self.keys = numpy.array(
+            [-1 if k is None else self.keyids[k] for k in doc.keys],
+            dtype=numpy.int64)
+        self.nums = numpy.array([-1 if k is None else k for k in doc.nums],
+                                dtype=numpy.int64)
+        self.tots = numpy.array([-1 if k is None else k for k in doc.tots],
+                                dtype=numpy.int64)
+
+        # The subtree below node i is the run of nodes first[i] .. i - 1.
+        first = list(range(n))
+        for i, kids in enumerate(doc.children):
+            if kids:
+                first[i] = first[kids[0]]
+        self.first = numpy.array(first, dtype=numpy.int64)
+
+        # Numbers which can't be held exactly as floats (i.e. huge integers)
+        # are compared one at a time.
+        values = [float('nan')] * n
+        inexact = []
+        for i in doc.by_type.get(_NUMBER, ()):
+            v = doc.nodes[i]
+            try:
+                f = float(v)
+            except OverflowError:
+                f = float('nan')
+            if f != v and v == v:
+                inexact.append(i)
+            values[i] = f
+        self.values = numpy.array(values, dtype=numpy.float64)
+        self.inexact = numpy.array(inexact, dtype=numpy.int64)
+
+    def run(self, states, stats=None):
+        '''Returns the numbers of the nodes which match a _StateSet, in order.
+        :has() searches and :expr() tests are counted in stats, if it's given.'''
+        if states is None:
+            return []
+        ctx = _Context(stats)
+        initial = set(states.states)
+        order, preds = _topological(states.states)
+        tests = {}  # _Simple -> mask of the nodes passing its vectorized tests
+        matched = {}  # _State -> mask of the nodes it matched
+        found = numpy.zeros(self.n, dtype=bool)
+        for st in order:
+            # which nodes is the state tested against?
+            reach = numpy.zeros(self.n, dtype=bool)
+            if st in initial:
+                if st.repeat:
+                    reach[:] = True
+                else:
+                    reach[self.n - 1] = True
+            for pred in preds.get(st, ()):
+                if st.repeat:
+                    reach |= self.below(matched[pred])
+                else:
+                    reach |= self.children(matched[pred])
+
+            m = self.match(st.simple, reach, tests, ctx)
+            if st.sibs and m.any():
+                # the siblings may be any children of the nodes' parents.
+                within = self.children(self.parentsOf(m))
+                for sib in st.sibs:
+                    m &= self.parentsOf(self.match(sib, within, tests, ctx),
+                                        children=True)
+            if st.tail is not None:
+                nodes = self.doc.nodes
+                for i in numpy.nonzero(m)[0]:
+                    if not ctx.exists(st.tail, nodes[i]):
+                        m[i] = False
+            matched[st] = m
+            if st.next is None:
+                found |= m
+        return numpy.nonzero(found)[0].tolist()
+
+    def match(self, simple, within, tests, ctx):
+        '''Returns the mask of the nodes in within which match the _Simple.'''
+        m = tests.get(simple)
+        if m is None:
+            m = tests[simple] = self.test(simple)
+        m = m & within
+        if not simple.has and simple.expr is None:
+            return m
+        nodes = self.doc.nodes
+        for states in simple.has:
+            if states is None:
+                return numpy.zeros(self.n, dtype=bool)
+            for i in numpy.nonzero(m)[0]:
+                if not ctx.exists(states, nodes[i]):
+                    m[i] = False
+        if simple.expr is not None:
+            e = self.expr(simple.source)
+            if e is None:
+                for i in numpy.nonzero(m)[0]:
+                    if not simple.expr(nodes[i]):
+                        m[i] = False
+            else:
+                retest = self.inexact[m[self.inexact]]
+                m &= e
+                for i in retest:
+                    m[i] = bool(simple.expr(nodes[i]))
+        return m
+
+    def test(self, simple):
+        '''Returns the mask of the nodes which pass a _Simple's type, id and
+        :nth-child tests.'''
+        m = numpy.ones(self.n, dtype=bool)
+        if simple.type is not None:
+            m &= self.codes == simple.type
+        if simple.id is not None:
+            m &= self.keys == self.keyids.get(simple.id, -2)
+        if simple.nth is not None:
+            if simple.nth == ':nth-last-child':
+                pos = self.tots - self.nums
+            else:
+                pos = self.nums + 1
+            if simple.a == 0:
+                m &= pos == simple.b
+            else:
+                m &= ((pos - simple.b) % simple.a == 0) & \
+                    (pos * simple.a + simple.b >= 0)
+            m &= self.nums >= 0  # only array elements have a position.
+        return m
+
+    def expr(self, expr):
+        '''Returns the truth of a parsed expression for each node, or None if
+        it has to be evaluated one node at a time.'''
+        if not isinstance(expr, list):
+            if expr is Undefined:
+                return None
+            return numpy.full(self.n, bool(expr), dtype=bool)
+        lhs, op, rhs = expr
+        if op == '&&' or op == '||':
+            l = self.expr(lhs)
+            r = l is not None and self.expr(rhs)
+            if l is None or r is None:
+                return None
+            return l & r if op == '&&' else l | r
+        if op in _orderings:
+            if lhs is Undefined and _isNumber(rhs):
+                return (self.codes == _NUMBER) & _orderings[op](self.values,
+                                                                rhs)
+            if rhs is Undefined and _isNumber(lhs):
+                return (self.codes == _NUMBER) & _orderings[op](lhs,
+                                                                self.values)
+        return None
+
+    def children(self, mask):
+        '''Returns the mask of the children of the nodes in mask.'''
+        # the root's parent is -1, i.e. the extra (False) entry.
+        return numpy.append(mask, False)[self.parents]
+
+    def parentsOf(self, mask, children=False):
+        '''Returns the mask of the parents of the nodes in mask, or if children
+        is set, of all of those parents' children.'''
+        has = numpy.zeros(self.n + 1, dtype=bool)
+        has[self.parents[mask]] = True
+        has[self.n] = False
+        if children:
+            return has[self.parents]
+        return has[:self.n]
+
+    def below(self, mask):
+        '''Returns the mask of the nodes below the nodes in mask.'''
+        idx = numpy.nonzero(mask)[0]
+        if not len(idx):
+            return mask.copy()
+        depth = numpy.zeros(self.n + 1, dtype=numpy.int64)
+        numpy.add.at(depth, self.first[idx], 1)
+        numpy.add.at(depth, idx, -1)
+        return numpy.cumsum(depth[:self.n]) > 0
+
+
+def _topological(states):
+    '''Orders the _States reachable from states so that each comes after the
+    states whose next it is. Returns (order, {_State: [preceding _States]}).'''
+    preds = {}
+    seen = set()
+    stack = list(states)
+    while stack:
+        st = stack.pop()
+        if st in seen:
+            continue
+        seen.add(st)
+        if st.next is not None:
+            preds.setdefault(st.next, []).append(st)
+            stack.append(st.next)
+    waiting = dict((st, len(preds.get(st, ()))) for st in seen)
+    ready = [st for st in states if not waiting[st]]
+    order = []
+    while ready:
+        st = ready.pop()
+        order.append(st)
+        if st.next is not None:
+            waiting[st.next] -= 1
+            if not waiting[st.next]:
+                ready.append(st.next)
+    return order, preds
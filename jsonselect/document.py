@@ -0,0 +1,292 @@
+'''An index over a JSON object, for matching many selectors against it.
+
+Usage:
+
+    doc = jsonselect.Document(config)
+    for v in doc.match('.servers > * > .port'):
+        ...
+
+match() walks the whole object each time it's called. A Document walks it once
+up front, recording each node's parent, key or position and type, and then
+matches selectors from the right: the nodes which can match the last simple
+selector are looked up by key (or type), and only their ancestors are checked
+against the rest of the selector.
+
+The index isn't updated if the object changes; build a new Document instead.
+
+With engine='numpy', selectors are evaluated for all the nodes at once with
+NumPy array operations instead (see columns.py). This falls back to the pure
+Python engine if NumPy isn't installed.
+'''
+
+from . import columns
+from .jsonselect import (Selector, compile, iteritems, _Context, _nodetypes,
+                         _typecode, _ARRAY, _OBJECT)
+
+
+class Document(object):
+    '''A JSON object, indexed for repeated matching.
+
+    The nodes are numbered in post-order, the order in which match() yields
+    them, and these attributes are indexed by that number:
+
+        nodes: the values themselves
+        codes: their type codes
+        parents: the number of each node's parent (None for the root)
+        keys: the key of each object member (None for other nodes)
+        nums: the index of each array element (None for other nodes)
+        tots: the length of each array element's parent (None for other nodes)
+        children: the numbers of each container's children, in order
+
+    by_key maps each key to the numbers of the nodes with that key, and by_type
+    maps each type code to the numbers of the nodes of that type.
+
+    engine is either 'python' or 'numpy'.
+    '''
+
+    def __init__(self, obj, engine='python'):
+        if engine not in ('python', 'numpy'):
+            raise ValueError('Unknown engine: %s' % engine)
+        self.obj = obj
+        self.nodes = []
+        self.codes = []
+        self.parents = []
+        self.keys = []
+        self.nums = []
+        self.tots = []
+        self.children = []
+        self.by_key = {}
+        self.by_type = {}
+
+        # (container, type code, key, index, siblings, children iterator,
+        #  numbers of the children indexed so far)
+        stack = []
+        node, Id, num, tot = obj, None, None, None
+        while True:
+            code = _nodetypes.get(type(node)) or _typecode(node)
+            if code == _ARRAY and node:
+                stack.append((node, code, Id, num, tot, enumerate(node), []))
+            elif code == _OBJECT and node:
+                stack.append((node, code, Id, num, tot,
+                              iter(iteritems(node)), []))
+            else:
+                i = self._add(node, code, Id, num, tot, ())
+                if stack:
+                    stack[-1][6].append(i)
+
+            while stack:
+                parent, pcode, pId, pnum, ptot, children, kids = stack[-1]
+                try:
+                    k, node = next(children)
+                except StopIteration:
+                    stack.pop()
+                    i = self._add(parent, pcode, pId, pnum, ptot, kids)
+                    if stack:
+                        stack[-1][6].append(i)
+                    continue
+                if pcode == _ARRAY:
+                    Id, num, tot = None, k, len(parent)
+                else:
+                    Id, num, tot = k, None, None
+                break
+            else:
+                break
+
+        self.columns = None
+        if engine == 'numpy' and columns.numpy is not None:
+            self.columns = columns.Columns(self)
+
+    def _add(self, node, code, Id, num, tot, kids):
+        i = len(self.nodes)
+        self.nodes.append(node)
+        self.codes.append(code)
+        self.parents.append(None)
+        self.keys.append(Id)
+        self.nums.append(num)
+        self.tots.append(tot)
+        self.children.append(kids)
+        for kid in kids:
+            self.parents[kid] = i
+        if Id is not None:
+            self.by_key.setdefault(Id, []).append(i)
+        self.by_type.setdefault(code, []).append(i)
+        return i
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def match(self, sel, arr=None, stats=None):
+        '''Match a selector to the document, yielding the matched values in the
+        same order as jsonselect.match() would.
+
+        Args:
+            sel: The JSONSelect selector to apply (a string or a compiled
+                 Selector)
+            arr: If sel contains ? characters, then the values in this array
+                 will be safely interpolated into the selector.
+            stats: A jsonselect.Stats, in which to count the work done. The
+                 numpy engine only counts :has() searches and :expr() tests.
+        '''
+        return iter([self.nodes[i] for i in self.numbers(sel, arr, stats)])
+
+    def numbers(self, sel, arr=None, stats=None):
+        '''Like match(), but returns the numbers of the matching nodes.'''
+        if not isinstance(sel, Selector):
+            sel = compile(sel, arr)
+        if self.columns is not None:
+            return self.columns.run(sel._states, stats)
+        return _Query(self, sel._states, stats).run()
+
+
+class _Query(object):
+    '''Matches the states of one selector against a Document, right to left.'''
+
+    def __init__(self, doc, states, stats=None):
+        self.doc = doc
+        self.ctx = _Context(stats)
+        self.stats = stats
+        self.memo = {}  # (_State, node number) -> bool
+        self.sibs = {}  # (_Simple, parent's number) -> bool
+        self.initial = set()
+        self.preds = {}  # _State -> the _States whose next it is
+        self.terminals = []
+        if states is None:
+            return
+        self.initial.update(states.states)
+        stack = list(states.states)
+        seen = set()
+        while stack:
+            st = stack.pop()
+            if st in seen:
+                continue
+            seen.add(st)
+            if st.next is None:
+                self.terminals.append(st)
+            else:
+                self.preds.setdefault(st.next, []).append(st)
+                stack.append(st.next)
+
+    def run(self):
+        '''Returns the numbers of the matching nodes, in order.'''
+        found = set()
+        doc = self.doc
+        for st in self.terminals:
+            if (st.repeat and st in self.initial and st not in self.preds and
+                    not st.sibs and st.tail is None):
+                # a selector like "string", which any node might match: there
+                # are no ancestors to check, so test the nodes directly.
+                match = st.simple.match
+                cands = self.candidates(st)
+                if self.stats is not None:
+                    self.stats.nodes += len(cands)
+                    self.stats._test(st.simple, len(cands))
+                for i in cands:
+                    if match(doc.nodes[i], doc.codes[i], doc.keys[i],
+                             doc.nums[i], doc.tots[i], self.ctx):
+                        found.add(i)
+                continue
+            for i in self.candidates(st):
+                if i not in found and self.ok(st, i):
+                    found.add(i)
+        return sorted(found)
+
+    def candidates(self, st):
+        '''Returns the numbers of the nodes which the _State might match.'''
+        doc = self.doc
+        simple = st.simple
+        if simple.id is not None:
+            return doc.by_key.get(simple.id, ())
+        if not st.repeat:
+            # only the root, or the children of the nodes which matched the
+            # state before it.
+            out = []
+            if st in self.initial:
+                out.append(len(doc.nodes) - 1)
+            for pred in self.preds.get(st, ()):
+                for p in self.candidates(pred):
+                    if self.ok(pred, p):
+                        out.extend(self.children(simple, p))
+            return out
+        if simple.nth is not None:
+            out = []
+            for p in doc.by_type.get(_ARRAY, ()):
+                out.extend(self.children(simple, p))
+            return out
+        if simple.type is not None:
+            return doc.by_type.get(simple.type, ())
+        return range(len(doc.nodes))
+
+    def children(self, simple, p):
+        '''Returns the numbers of node p's children which the _Simple might
+        match, going by their positions.'''
+        doc = self.doc
+        kids = doc.children[p]
+        if simple.nth is None:
+            return kids
+        if doc.codes[p] != _ARRAY:
+            return ()
+        return [kids[k] for k in simple.indices(len(kids))]
+
+    def ok(self, st, i):
+        '''Would the _State be tested against node i, and match it?'''
+        key = (st, i)
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        result = self.memo[key] = self._test(st, i)
+        return result
+
+    def _test(self, st, i):
+        doc = self.doc
+        node = doc.nodes[i]
+        p = doc.parents[i]
+        if self.stats is not None:
+            self.stats.nodes += 1
+            self.stats._test(st.simple)
+        if not st.simple.match(node, doc.codes[i], doc.keys[i], doc.nums[i],
+                               doc.tots[i], self.ctx):
+            return False
+        if st.sibs:
+            if p is None:
+                return False
+            for sib in st.sibs:
+                if not self.sibling(sib, p):
+                    return False
+        if st.tail is not None and not self.ctx.exists(st.tail, node):
+            return False
+
+        # A state is tested against the root, if it's the start of the
+        # selector, or against the children of the nodes which matched the
+        # state before it. If it repeats, then it's tested against all of their
+        # descendants, too.
+        if st in self.initial and (st.repeat or p is None):
+            return True
+        for pred in self.preds.get(st, ()):
+            if not st.repeat:
+                if p is not None and self.ok(pred, p):
+                    return True
+                continue
+            a = p
+            while a is not None:
+                if self.ok(pred, a):
+                    return True
+                a = doc.parents[a]
+        return False
+
+    def sibling(self, simple, p):
+        '''Does any child of node p match the _Simple?'''
+        key = (simple, p)
+        try:
+            return self.sibs[key]
+        except KeyError:
+            pass
+        doc = self.doc
+        result = False
+        for kid in doc.children[p]:
+            if simple.match(doc.nodes[kid], doc.codes[kid], doc.keys[kid],
+                            doc.nums[kid], doc.tots[kid], self.ctx):
+                result = True
+                break
+        self.sibs[key] = result
+        return result
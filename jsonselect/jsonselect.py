@@ -21,21 +21,48 @@ function to match():
     for v in jsonselect.match('.foo', obj, bailout_fn=filter_fn):
         print v
 
-For large objects, suitable pruning can result in a massive speedup.
+For large objects, suitable pruning can result in a massive speedup. The
+matcher already skips the subtrees which the selector can't reach (e.g. below
+the second level for ":root > .foo > .bar", or the strings and numbers for
+"object"), so bailout_fn is only needed for pruning which depends on the data.
+Selector.analyze() and Stats show what the matcher works out for itself.
+
+If you apply the same selector many times, compile it once and reuse it:
+
+    sel = jsonselect.compile('.foo')
+    for obj in objs:
+        for v in sel.match(obj):
+            print v
+
+match() keeps a bounded LRU cache of compiled selectors, so repeated calls with
+the same selector string are cheap, too. See cache_info(). Compiled selectors
+can be pickled, and cache_save() and cache_load() keep the cache on disk, for
+processes which would otherwise compile the same selectors each time they
+start.
 
 Aside from bailout_fn, this is a direct port of the jsonselect.js reference
 implementation.
 '''
 
 import json
+import operator
+import os
+import pickle
 import re
 import sys
+import threading
+import timeit
+from collections import OrderedDict, namedtuple
+
+# setup.py reads the version from here, and cache_load() checks it.
+__version__ = '0.2.2'
 
 PY3 = sys.version_info[0] == 3
 
 
 if PY3:
     stringtype=str
+    irange=range
     
     def iteritems(d):
         return d.items()
@@ -44,6 +71,7 @@ if PY3:
         return d.keys()
 else:
     stringtype=basestring
+    irange=xrange
 
     def iteritems(d):
         return d.iteritems()
@@ -99,7 +127,7 @@ class toks(object):
 
 # The primary lexing regular expression in jsonselect
 pat = re.compile(
-    "^(?:" +
+    "(?:" +
     # (1) whitespace
     "([\\r\\n\\t\\ ]+)|" +
     # (2) one-char ops
@@ -124,15 +152,36 @@ pat = re.compile(
 )
 
 
-def _reExec(regex, string):
-    '''This returns [full match, group1, group2, ...], just like JS.'''
-    m = regex.search(string)
+def _reExec(regex, string, pos=0):
+    '''This returns [full match, group1, group2, ...], just like JS.
+
+    The match is anchored at pos, which avoids slicing off the string's tail.
+    '''
+    m = regex.match(string, pos)
     if not m: return None
     return [m.group()] + list(m.groups())
 
 
+# typeof for the exact types which JSON decodes to, so that the common case is a
+# single dict lookup.
+_typeofs = {
+    type(None): 'object',
+    bool: 'boolean',
+    int: 'number',
+    float: 'number',
+    str: 'string',
+    type(u''): 'string',
+    list: 'object',
+    dict: 'object',
+    OrderedDict: 'object'
+}
+
+
 def _jsTypeof(o):
     '''Return a string similar to JS's typeof.'''
+    t = _typeofs.get(type(o))
+    if t:
+        return t
     if o == None:
         return 'object'
     elif o == Undefined:
@@ -149,10 +198,10 @@ def _jsTypeof(o):
 
 
 # A regular expression for matching "nth expressions" (see grammar, what :nth-child() eats)
-nthPat = re.compile(r'^\s*\(\s*(?:([+\-]?)([0-9]*)n\s*(?:([+\-])\s*([0-9]))?|(odd|even)|([+\-]?[0-9]+))\s*\)')
+nthPat = re.compile(r'\s*\(\s*(?:([+\-]?)([0-9]*)n\s*(?:([+\-])\s*([0-9]))?|(odd|even)|([+\-]?[0-9]+))\s*\)')
 def lex(string, off=None):
     if not off: off = 0
-    m = _reExec(pat, string[off:])
+    m = _reExec(pat, string, off)
     if not m: return None
     off+=len(m[0])
     a = None
@@ -169,11 +218,45 @@ def lex(string, off=None):
     return a
 
 
+class _Tokenizer(object):
+    '''Lexes a selector string, remembering each token by its offset.
+
+    The parser asks for the token at a given offset several times (e.g. after
+    parse_selector() returns, parse() looks at the same token again), so this
+    makes sure that each position in the string is only scanned once.
+    Tokens are shared between callers and must not be modified.
+    '''
+    def __init__(self, string):
+        self.string = string
+        self._toks = {}
+        self._exprToks = {}
+
+    def lex(self, off):
+        try:
+            return self._toks[off]
+        except KeyError:
+            t = self._toks[off] = lex(self.string, off)
+            return t
+
+    def exprLex(self, off):
+        try:
+            return self._exprToks[off]
+        except KeyError:
+            t = self._exprToks[off] = exprLex(self.string, off)
+            return t
+
+
+def _tokenizer(string):
+    if isinstance(string, _Tokenizer):
+        return string
+    return _Tokenizer(string)
+
+
 # THE EXPRESSION SUBSYSTEM
 
 exprPat = re.compile(
         # skip and don't capture leading whitespace
-        "^\\s*(?:" +
+        "\\s*(?:" +
         # (1) simple vals
         "(true|false|null)|" +
         # (2) numbers
@@ -227,7 +310,7 @@ class Undefined(object):
 
 
 def exprLex(string, off):
-    m = _reExec(exprPat, string[off:])
+    m = _reExec(exprPat, string, off)
     v = None
     if m:
         off += len(m[0])
@@ -239,57 +322,86 @@ def exprLex(string, off):
         return [off, v]
 
 
-def exprParse2(string, off):
-    if (not off): off = 0
-    # first we expect a value or a '('
-    l = exprLex(string, off)
-    lhs = Undefined
-    if l and l[1] == '(':
-        lhs = exprParse2(string, l[0])
-        p = exprLex(string, lhs[0])
-        if not p or p[1] != ')': te('epex', string)
-        off = p[0]
-        lhs = [ '(', lhs[1] ]
-    elif not l or (l[1] and l[1] != 'x'):
-        te("ee", string + " - " + ( l[1] and l[1] ))
-    else:
-        lhs = Undefined if (l[1] == 'x') else l[2]
+def _precedence(op):
+    # a misplaced '(' (see _exprParse) binds more loosely than any operator.
+    return operators[op][0] if op != '(' else 0
+
+
+def _exprParse(tk, off, parens, hints=None):
+    '''Parses an expression with an operator-precedence parser.
+
+    This consumes the token stream from left to right with explicit stacks, so
+    long expressions parse in linear time and don't exhaust the Python stack.
+    If parens is set, parenthesized sub-expressions are wrapped as ['(', e].
+    If a '(' follows a value, the error is raised here, or, given hints, left
+    to parse() once the rest of the selector has been read.
+    '''
+    string = tk.string
+    outer = []  # (vals, ops) of the expressions enclosing each open paren
+    vals = []
+    ops = []
+    misplaced = False  # whether a '(' followed a value
+
+    def reduce_one():
+        rhs = vals.pop()
+        vals.append([vals.pop(), ops.pop(), rhs])
+
+    while True:
+        # first we expect a value or a '('
+        l = tk.exprLex(off)
+        if l and l[1] == '(':
+            outer.append((vals, ops))
+            vals = []
+            ops = []
+            off = l[0]
+            continue
+        elif not l or (l[1] and l[1] != 'x'):
+            te("ee", string + (" - " + l[1] if l else ""))
+        vals.append(l[2])
         off = l[0]
 
-    # now we expect a binary operator or a ')'
-    op = exprLex(string, off)
-    if not op or op[1] == ')':
-        return [off, lhs]
-    elif op[1] == 'x' or not op[1]:
-        te('bop', string + " - " + ( op[1] and op[1] ))
+        # now we expect a binary operator or a ')'
+        while True:
+            op = tk.exprLex(off)
+            if not op or op[1] == ')':
+                while ops:
+                    reduce_one()
+                if not outer:
+                    if misplaced:
+                        if hints is None:
+                            te('bop', string)
+                        hints['misplacedParen'] = True
+                    return [off, vals[0]]
+                if not op:
+                    te('epex', string)
+                off = op[0]
+                v = vals[0]
+                vals, ops = outer.pop()
+                vals.append(['(', v] if parens else v)
+                continue
+            elif not op[1]:
+                te('bop', string)
+            elif op[1] == '(':
+                # a '(' here isn't an operator, but it's parsed as one, as it
+                # always has been, so that errors further on are reported
+                # first.
+                misplaced = True
+            # left-associative, so pending operators of equal precedence
+            # are applied first.
+            prec = _precedence(op[1])
+            while ops and _precedence(ops[-1]) >= prec:
+                reduce_one()
+            ops.append(op[1])
+            off = op[0]
+            break
 
-    # tail recursion to fetch the rhs expression
-    rhs = exprParse2(string, op[0])
-    off = rhs[0]
-    rhs = rhs[1]
 
-    # and now precedence!  how shall we put everything together?
-    v = None
-    if _jsTypeof(rhs) != 'object' or rhs[0] == '(' or operators[op[1]][0] < operators[rhs[1]][0]:
-        v = [lhs, op[1], rhs]
-    else:
-        v = rhs
-        while _jsTypeof(rhs[0]) == 'object' and rhs[0][0] != '(' and operators[op[1]][0] >= operators[rhs[0][1]][0]:
-            rhs = rhs[0]
-        rhs[0] = [lhs, op[1], rhs[0]]
-    return [off, v]
-
-
-def exprParse(string, off):
-    def deparen(v):
-        if _jsTypeof(v) != 'object' or v == None:
-            return v
-        elif v[0] == '(':
-            return deparen(v[1])
-        else:
-            return [deparen(v[0]), v[1], deparen(v[2])]
-    e = exprParse2(string, off or 0)
-    return [e[0], deparen(e[1])]
+def exprParse2(string, off):
+    return _exprParse(_tokenizer(string), off or 0, True)
+
+
+def exprParse(string, off, hints=None):
+    return _exprParse(_tokenizer(string), off or 0, False, hints)
 
 
 def exprEval(expr, x):
@@ -302,11 +414,134 @@ def exprEval(expr, x):
     return operators[expr[1]][1](lhs, rhs)
 
 
+# THE EXPRESSION COMPILER
+
+def _identity(x):
+    return x
+
+
+# The comparisons which only hold between two numbers or two strings, without
+# the type checks which their entries in |operators| perform.
+_rawComparisons = {
+    '<=': operator.le,
+    '>=': operator.ge,
+    '<':  operator.lt,
+    '>':  operator.gt,
+    '$=': lambda lhs, rhs: lhs.rfind(rhs) == len(lhs) - len(rhs),
+    '^=': lambda lhs, rhs: lhs.find(rhs) == 0,
+    '*=': lambda lhs, rhs: lhs.find(rhs) != -1
+}
+_stringComparisons = ('$=', '^=', '*=')
+
+
+def _compileExpr(expr):
+    '''Compiles a parsed expression into a function of x.
+
+    The function returns exactly what exprEval(expr, x) would, but the tree is
+    only walked once, here: constant sub-expressions are folded, and
+    comparisons against a literal only check the type of the other operand.
+    '''
+    const, v = _exprCode(expr)
+    if const:
+        return lambda x: v
+    return v
+
+
+def _exprCode(expr):
+    '''Returns (True, value) for constant expressions, else (False, fn).'''
+    if expr == Undefined:
+        return False, _identity
+    if expr == None or _jsTypeof(expr) != 'object':
+        return True, expr
+    # Operators are left-associative, so walk down the left spine iteratively
+    # and only recurse on right-hand sides.
+    spine = []
+    while isinstance(expr, list):
+        spine.append(expr)
+        expr = expr[0]
+    code = _exprCode(expr)
+    for node in reversed(spine):
+        code = _exprBinary(code, node[1], _exprCode(node[2]))
+    return code
+
+
+def _exprBinary(lhs, op, rhs):
+    fn = operators[op][1]
+    lconst, l = lhs
+    rconst, r = rhs
+    if lconst and rconst:
+        try:
+            return True, fn(l, r)
+        except Exception:
+            pass  # leave the error for evaluation time, as exprEval would.
+    elif (lconst or rconst) and op in _rawComparisons:
+        return _exprTypedComparison(op, l, r, lconst)
+    return False, _exprApply(fn, lhs, rhs)
+
+
+def _exprTypedComparison(op, l, r, lconst):
+    '''Specializes a comparison where one operand is the literal value.'''
+    c, other = (l, r) if lconst else (r, l)
+    t = _jsTypeof(c)
+    if t == 'string' or (t == 'number' and op not in _stringComparisons):
+        raw = _rawComparisons[op]
+        if lconst:
+            test = lambda v: _jsTypeof(v) == t and raw(c, v)
+        else:
+            test = lambda v: _jsTypeof(v) == t and raw(v, c)
+        if other is _identity:
+            return False, test
+        return False, lambda x: test(other(x))
+
+    # e.g. x < true or x ^= 1, which never hold.
+    if other is _identity:
+        return True, False
+    def never(x):
+        other(x)
+        return False
+    return False, never
+
+
+def _exprApply(fn, lhs, rhs):
+    '''Binds the operands of a binary operator, evaluating both eagerly.'''
+    lconst, l = lhs
+    rconst, r = rhs
+    if lconst and rconst:
+        return lambda x: fn(l, r)
+    if lconst:
+        if r is _identity:
+            return lambda x: fn(l, x)
+        return lambda x: fn(l, r(x))
+    if rconst:
+        if l is _identity:
+            return lambda x: fn(x, r)
+        return lambda x: fn(l(x), r)
+    if l is _identity and r is _identity:
+        return lambda x: fn(x, x)
+    if l is _identity:
+        return lambda x: fn(x, r(x))
+    if r is _identity:
+        return lambda x: fn(l(x), x)
+    return lambda x: fn(l(x), r(x))
+
+
 # THE PARSER
 
 def parse(string, off=0, nested=None, hints=None):
     if not hints: hints = {}
     if not nested: hints = {}
+    off, rv = _parse(string, off, nested, hints)
+    if not nested and hints.get('misplacedParen'):
+        te('bop', _tokenizer(string).string)
+    if not nested and (hints.get('usesSiblingOp') or hints.get('usesSubject')):
+        rv = normalize(rv)
+    return [off, rv]
+
+
+def _parse(string, off, nested, hints):
+    '''Parses a selector without rewriting its ~ and ! operators.'''
+    tk = _tokenizer(string)
+    string = tk.string
 
     a = []
     am = None
@@ -314,13 +549,13 @@ def parse(string, off=0, nested=None, hints=None):
     if not off: off = 0
 
     while True:
-        s = parse_selector(string, off, hints)
+        s = parse_selector(tk, off, hints)
         a.append(s[1])
         off = s[0]
-        s = lex(string, off)
+        s = tk.lex(off)
         if s and s[1] == " ":
             off = s[0]
-            s = lex(string, off)
+            s = tk.lex(off)
         if not s:
             break
         # now we've parsed a selector, and have something else...
@@ -347,12 +582,7 @@ def parse(string, off=0, nested=None, hints=None):
         te("mcp", string)
     if am:
         am.append(a)
-    rv = None
-    if not nested and (hints.get('usesSiblingOp') or hints.get('usesSubject')):
-        rv = normalize(am or a);
-    else:
-        rv = am or a
-    return [off, rv]
+    return [off, am or a]
 
 
 def normalizeOne(sel):
@@ -416,22 +646,24 @@ def normalize(sels):
 
 
 def parse_selector(string, off, hints):
+    tk = _tokenizer(string)
+    string = tk.string
     soff = off
     s = { }
-    l = lex(string, off)
+    l = tk.lex(off)
     # skip space
     if l and l[1] == " ":
         soff = off = l[0]
-        l = lex(string, off)
+        l = tk.lex(off)
     if l and l[1] == toks.typ:
         s['type'] = l[2]
         off = l[0]
-        l = lex(string, off)
+        l = tk.lex(off)
     elif l and l[1] == "*":
         # don't bother representing the universal sel, '*' in the
         # parse tree, cause it's the default
         off = l[0]
-        l = lex(string, off)
+        l = tk.lex(off)
     elif l and l[1] == "!":
         off = l[0]
         s['subject'] = True
@@ -463,51 +695,55 @@ def parse_selector(string, off, hints):
                 s['expr'] = [ Undefined, '=' if l[2] == ":val" else "*=", Undefined]
                 # any amount of whitespace, followed by paren, string, paren
                 off = l[0]
-                l = lex(string, off)
+                l = tk.lex(off)
                 if l and l[1] == " ":
                     off = l[0]
-                    l = lex(string, off)
+                    l = tk.lex(off)
                 if not l or l[1] != "(":
                     te("pex", string)
                 off = l[0]
-                l = lex(string, off)
+                l = tk.lex(off)
                 if l and l[1] == " ":
                     off = l[0]
-                    l = lex(string, off)
+                    l = tk.lex(off)
                 if not l or (l[1] != toks.str and l[1] != toks.num):
                     te("snex", string)
                 s['expr'][2] = l[2]
                 off = l[0]
-                l = lex(string, off)
+                l = tk.lex(off)
                 if l and l[1] == " ":
                     off = l[0]
-                    l = lex(string, off)
+                    l = tk.lex(off)
                 if not l or l[1] != ")":
                     te("epex", string)
             elif l[2] == ":has":
                 # any amount of whitespace, followed by paren
                 off = l[0]
-                l = lex(string, off)
+                l = tk.lex(off)
                 if l and l[1] == " ":
                     off = l[0]
-                    l = lex(string, off)
+                    l = tk.lex(off)
                 if not l or l[1] != "(":
                     te("pex", string)
-                h = parse(string, l[0], True)
-                l[0] = h[0]
+                h = _parse(tk, l[0], True, {})
                 if not s.get('has'): s['has'] = []
                 s['has'].append(h[1])
+                off = h[0]
+                l = tk.lex(off)
+                continue
             elif l[2] == ":expr":
                 if s.get('expr'):
                     te("mexp", string)
-                e = exprParse(string, l[0])
-                l[0] = e[0]
+                e = exprParse(tk, l[0], hints)
                 s['expr'] = e[1]
+                off = e[0]
+                l = tk.lex(off)
+                continue
             else:
                 if s.get('pc') or s.get('pf'):
                     te("mpc", string)
                 s['pf'] = l[2];
-                m = _reExec(nthPat, string[l[0]:])
+                m = _reExec(nthPat, string, l[0])
                 if not m:
                     te("mepf", string)
                 if m[5]:
@@ -519,11 +755,13 @@ def parse_selector(string, off, hints):
                 else:
                     s['a'] = int((m[1] or "+") + (m[2] or "1"))
                     s['b'] = int(m[3] + m[4]) if m[3] else 0
-                l[0] += len(m[0])
+                off = l[0] + len(m[0])
+                l = tk.lex(off)
+                continue
         else:
             break
         off = l[0]
-        l = lex(string, off)
+        l = tk.lex(off)
 
     # now if we didn't actually parse anything it's an error
     if soff == off:
@@ -547,119 +785,1316 @@ def mytypeof(o):
     return to
 
 
-# mn = "match node"?
-def mn(node, sel, Id, num, tot):
-    sels = []
-    cs = sel[1] if sel[0] == '>' else sel[0]
-    m = True
-    mod = None
-    if cs.get('type'):
-        m = m and (cs['type'] == mytypeof(node))
-    if cs.get('id'):
-        m = m and (cs['id'] == Id)
-    if m and cs.get('pf'):
-        if cs['pf'] == ":nth-last-child":
-            if num == None or tot == None:
-                num = float('nan')  # mirror JS quirk
-            else:
-                num = tot - num
+# Integer codes for the types named by mytypeof().
+_NULL, _BOOLEAN, _NUMBER, _STRING, _ARRAY, _OBJECT = range(1, 7)
+_typecodes = {
+    'null': _NULL,
+    'boolean': _BOOLEAN,
+    'number': _NUMBER,
+    'string': _STRING,
+    'array': _ARRAY,
+    'object': _OBJECT
+}
+# ... and for the exact types which JSON decodes to, as a fast path.
+_nodetypes = {
+    type(None): _NULL,
+    bool: _BOOLEAN,
+    int: _NUMBER,
+    float: _NUMBER,
+    str: _STRING,
+    type(u''): _STRING,
+    list: _ARRAY,
+    dict: _OBJECT,
+    OrderedDict: _OBJECT
+}
+
+
+def _typecode(o):
+    '''Returns the type code of a node, i.e. mytypeof(o) as an int.'''
+    return _nodetypes.get(type(o)) or _typecodes[mytypeof(o)]
+
+
+# Bound on the number of :has() results remembered during a single match.
+_MAX_MEMO = 65536
+
+
+class _Context(object):
+    '''State shared by the searches which make up a single match.'''
+    __slots__ = ('has', 'stats')
+
+    def __init__(self, stats=None):
+        self.has = {}  # (id(node), _StateSet) -> bool
+        self.stats = stats
+
+    def exists(self, states, node):
+        '''Does anything at or below node match the _StateSet?
+
+        A :has() search only depends on the node it starts from, so each one is
+        run at most once per match (up to _MAX_MEMO of them).
+        '''
+        stats = self.stats
+        key = (id(node), states)
+        try:
+            found = self.has[key]
+        except KeyError:
+            pass
+        else:
+            if stats is not None:
+                stats.has_cached += 1
+            return found
+        if stats is not None:
+            stats.has_searches += 1
+            nodes = stats.nodes
+        found = False
+        for _ in _forEach(states, node, ctx=self):
+            found = True
+            break
+        if stats is not None:
+            # the nodes were counted as part of the main search; move them.
+            stats.has_nodes += stats.nodes - nodes
+            stats.nodes = nodes
+        if len(self.has) < _MAX_MEMO:
+            self.has[key] = found
+        return found
+
+
+class Stats(object):
+    '''Counts the work done by the matches which it's passed to.
+
+        stats = jsonselect.Stats()
+        list(jsonselect.match('object:has(.foo)', obj, stats=stats))
+        print(stats.as_dict())
+
+    The counts add up over all of those matches:
+
+        nodes: the nodes visited (or, for a Document, tested)
+        tests: how many times each simple selector was tested, by its text
+        max_pending: the most selector fragments pending at any one node
+        has_searches: the :has() searches run below a node (this includes the
+            searches for what follows the subject of "A !B C")
+        has_cached: the :has() searches which were answered from the memo
+        has_nodes: the nodes visited by :has() searches
+        pruned: the subtrees cut out of the search by bailout_fn or by the
+            prune, max_depth and prune_on_match options of match()
+        skips: why the children of containers weren't all visited, as a count
+            of the containers for each reason:
+                depth: the fragments pending at the node had no more levels
+                    to go (e.g. after ":root > .a > .b" matches two levels down)
+                fragments: nothing matched which had more levels to go
+                keys: only members with particular keys were visited, or in
+                    an array, none (e.g. for "> .a")
+                positions: only elements at particular positions were visited,
+                    or in an object, none (e.g. for "> :first-child")
+                scalars: only children which are containers were visited
+                    (e.g. for "object" or ".a > array")
+                bailout: bailout_fn returned True
+                prune: the node matched match()'s prune selector
+                max_depth: the node was max_depth levels down
+                prune_on_match: the node matched, with prune_on_match set
+        expr_calls, expr_time: the :expr() tests and the seconds spent in them
+
+    Matching without a Stats costs nothing extra; with one, it's a bit slower.
+    '''
+
+    def __init__(self):
+        self.nodes = 0
+        self.max_pending = 0
+        self.has_searches = 0
+        self.has_cached = 0
+        self.has_nodes = 0
+        self.pruned = 0
+        self.skips = {}
+        self.expr_calls = 0
+        self.expr_time = 0.0
+        self._tests = {}  # _Simple -> count
+
+    @property
+    def tests(self):
+        out = {}
+        for simple, n in iteritems(self._tests):
+            text = _describe(simple)
+            out[text] = out.get(text, 0) + n
+        return out
+
+    def as_dict(self):
+        '''Returns the counts as a dict, e.g. for json.dumps().'''
+        return OrderedDict([
+            ('nodes', self.nodes),
+            ('tests', OrderedDict(sorted(iteritems(self.tests)))),
+            ('max_pending', self.max_pending),
+            ('has_searches', self.has_searches),
+            ('has_cached', self.has_cached),
+            ('has_nodes', self.has_nodes),
+            ('pruned', self.pruned),
+            ('skips', OrderedDict(sorted(iteritems(self.skips)))),
+            ('expr_calls', self.expr_calls),
+            ('expr_time', self.expr_time),
+        ])
+
+    def __repr__(self):
+        return 'Stats(%s)' % ', '.join(
+            '%s=%r' % (k, v) for k, v in iteritems(self.as_dict()))
+
+    def _visit(self, states, runs):
+        self.nodes += 1
+        pending = 0
+        tests = self._tests
+        for ss in [states] + [run[0] for run in runs]:
+            if ss is None:
+                continue
+            pending += len(ss.states)
+            for test in ss.tests:
+                simple = test.__self__
+                tests[simple] = tests.get(simple, 0) + 1
+        if pending > self.max_pending:
+            self.max_pending = pending
+
+    def _skipped(self, code, states, pending, cut, keys, nths, scalars):
+        '''Records why a container's children weren't all visited, if they
+        weren't. cut is the reason the search was pruned there, if it was.'''
+        skips = self.skips
+        if cut is not None:
+            self.pruned += 1
+            why = (cut,)
+        elif states is None:
+            return
+        elif pending is None and keys is None and nths is None:
+            why = ('depth' if states.depth == 0 else 'fragments',)
         else:
-            if num != None:
-                num+=1
+            why = []
+            if nths == () or keys == ():
+                # none of the children can be tested.
+                why.append('keys' if code == _ARRAY else 'positions')
+            elif keys is not None:
+                why.append('keys')
+            elif nths is not None:
+                why.append('positions')
+            if not scalars:
+                why.append('scalars')
+        for reason in why:
+            skips[reason] = skips.get(reason, 0) + 1
+
+    def _test(self, simple, n=1):
+        self._tests[simple] = self._tests.get(simple, 0) + n
+
+    def _expr(self, expr, node):
+        start = timeit.default_timer()
+        try:
+            return expr(node)
+        finally:
+            self.expr_time += timeit.default_timer() - start
+            self.expr_calls += 1
+
+
+_typenames = dict((code, name) for name, code in iteritems(_typecodes))
+
+
+def _describe(simple):
+    '''Returns selector text for a _Simple, for Stats.'''
+    out = []
+    if simple.type is not None:
+        out.append(_typenames[simple.type])
+    if simple.id is not None:
+        if re.match(r'^[A-Za-z_][\w-]*$', simple.id):
+            out.append('.' + simple.id)
+        else:
+            out.append('.' + json.dumps(simple.id))
+    if simple.root:
+        out.append(':root')
+    if simple.nth is not None:
+        out.append('%s(%dn%+d)' % (simple.nth, simple.a, simple.b))
+    out.extend(':has(...)' for _ in simple.has)
+    if simple.expr is not None:
+        out.append(':expr(%s)' % _exprText(simple.source))
+    return ''.join(out) or '*'
+
+
+def _exprText(expr):
+    if isinstance(expr, list):
+        return '%s %s %s' % tuple(
+            '(%s)' % _exprText(e) if isinstance(e, list) else
+            e if isinstance(e, str) and i == 1 else _exprText(e)
+            for i, e in enumerate(expr))
+    if expr is Undefined:
+        return 'x'
+    return json.dumps(expr)
+
+
+class _Simple(object):
+    '''A compiled simple selector, e.g. "string.foo:nth-child(2n+1)".'''
+    __slots__ = ('type', 'id', 'nth', 'a', 'b', 'has', 'expr', 'root',
+                 'source')
+
+    def __init__(self, cs, program):
+        self.type = _typecodes[cs['type']] if cs.get('type') else None
+        self.id = cs.get('id') or None
+        # None, ":nth-child" or ":nth-last-child"; :first-child and :last-child
+        # have already been rewritten by the parser.
+        self.nth = cs.get('pf') or None
+        self.a = cs.get('a')
+        self.b = cs.get('b')
+        self.has = tuple(program.initial(h) for h in cs.get('has') or ())
+        self.expr = _compileExpr(cs['expr']) if cs.get('expr') else None
+        self.root = cs.get('pc') == ':root'
+        # the parsed expression, for engines which evaluate it their own way.
+        self.source = cs.get('expr') if self.expr is not None else None
+
+    def match(self, node, code, Id, num, tot, ctx):
+        '''Tests a node, given its type code, key, index and siblings count.'''
+        if self.type is not None and self.type != code:
+            return False
+        if self.id is not None and self.id != Id:
+            return False
+        if self.nth is not None and not self.position(num, tot):
+            return False
+        if self.has:
+            for states in self.has:
+                if states is None or not ctx.exists(states, node):
+                    return False
+        if self.expr is not None:
+            if ctx.stats is not None:
+                return ctx.stats._expr(self.expr, node)
+            return self.expr(node)
+        return True
+
+    def shallow(self, code, Id, num, tot):
+        '''Like match(), but skips the tests which need the node's value.'''
+        if self.type is not None and self.type != code:
+            return False
+        if self.id is not None and self.id != Id:
+            return False
+        return self.nth is None or self.position(num, tot)
+
+    def position(self, num, tot):
+        '''Does the index num in an array of length tot pass the :nth-child
+        test?'''
+        # only array elements have a position.
+        if num is None or tot is None:
+            return False
+        n = tot - num if self.nth == ':nth-last-child' else num + 1
+        if self.a == 0:
+            return n == self.b
+        return not (n - self.b) % self.a and n * self.a + self.b >= 0
+
+    def indices(self, tot):
+        '''Returns the indices in an array of length tot which can pass the
+        :nth-child test, in increasing order.'''
+        a, b = self.a, self.b
+        if a == 0:
+            n0, hi, step = b, min(b, tot), 1
+        else:
+            # positions n with (n - b) % a == 0 and n * a + b >= 0.
+            step = abs(a)
+            if a > 0:
+                lo, hi = max(1, -(b // a)), tot
             else:
-                num = float('nan')  # mirror a JS quirk which jsonselect uses
-        if cs.get('a') == 0:
-            m = cs.get('b') == num
+                lo, hi = 1, min(tot, b // -a)
+            n0 = lo + (b - lo) % step
+        if n0 < 1 or n0 > hi:
+            return irange(0)
+        nlast = n0 + (hi - n0) // step * step
+        if self.nth == ':nth-last-child':
+            return irange(tot - nlast, tot - n0 + 1, step)
+        return irange(n0 - 1, nlast, step)
+
+
+# Bounds on the size of the automaton which is built up for each selector.
+_MAX_STATE_SETS = 4096
+_MAX_TRANSITIONS = 256
+
+
+class _State(object):
+    '''A selector fragment: a simple selector to test against a node, and what
+    to pass down to the node's descendants.'''
+    __slots__ = ('simple', 'repeat', 'next', 'sibs', 'tail', 'out')
+
+    def __init__(self, simple, repeat, next, sibs=(), tail=None, out=None):
+        self.simple = simple
+        self.repeat = repeat  # should descendants be tested against this, too?
+        self.next = next  # the rest of the selector, if any, for the children
+        # for "A ~ B", the _Simples which some child of the node's parent must
+        # also match (this may be the node itself).
+        self.sibs = sibs
+        # for the subject of "A !B C", the _StateSet to search for from the
+        # node. It only matches if this finds something.
+        self.tail = tail
+        # for match_many(), the index of the selector which this completes.
+        self.out = out
+
+
+class _StateSet(object):
+    '''The distinct fragments which are pending at a node.
+
+    This is a state in a lazily-built automaton: transitions are cached by which
+    of the fragments' simple selectors matched the node, so each set is only
+    worked out once and the work per node is bounded by the number of distinct
+    simple selectors.
+
+    Sibling selectors are tested once per container, by siblings(), rather than
+    once per child.
+
+    If the set is only looking for children with particular keys (e.g. for
+    "> .foo" or ":root > .foo, :root > .bar") then keys lists them, so they can
+    be looked up rather than searched for. Likewise, nths lists the _Simples
+    which can match array elements if they're all :nth-child tests; then only
+    those positions (and containers, if deep) need visiting.
+
+    scalars lists the container types (_ARRAY and/or _OBJECT) whose scalar
+    children any of the fragments could match; elsewhere, only the children
+    which are containers need visiting. depth is how many levels below the
+    node the fragments can reach (None if they repeat, so there's no limit).
+    '''
+    __slots__ = ('states', 'tests', 'sibs', 'deep', 'keys', 'nths', 'scalars',
+                 'depth', '_first', '_bits', '_sibbits', '_program', '_trans',
+                 '_given')
+
+    def __init__(self, states, program):
+        self.states = states
+        sibs = []
+        for st in states:
+            for sib in st.sibs:
+                if sib not in sibs:
+                    sibs.append(sib)
+        simples = []
+        for st in states:
+            if st.simple not in simples:
+                simples.append(st.simple)
+        self.tests = tuple(simple.match for simple in simples)
+        self.sibs = tuple(sib.match for sib in sibs)
+        # are there fragments for the descendants of the children?
+        self.deep = any(st.repeat for st in states)
+        self.keys = self.nths = None
+        # a simple selector with an id can only match object members, and one
+        # with an :nth-child test can only match array elements.
+        if not sibs and all(simple.id is not None or simple.nth is not None
+                            for simple in simples):
+            self.nths = tuple(simple for simple in simples if simple.id is None)
+            if not self.deep:
+                self.keys = tuple(sorted(set(
+                    simple.id for simple in simples if simple.nth is None)))
+        # only object members have keys, and only array elements have
+        # positions.
+        self.scalars = tuple(code for code, unwanted in
+                             ((_ARRAY, 'id'), (_OBJECT, 'nth'))
+                             if any(getattr(simple, unwanted) is None and
+                                    (simple.type is None or
+                                     simple.type < _ARRAY)
+                                    for simple in simples))
+        self.depth = _depth(states)
+        # the low bits of a transition's mask are the siblings' results.
+        self._first = 1 << len(sibs)
+        self._bits = tuple(self._first << simples.index(st.simple)
+                           for st in states)
+        # a ~ chain may repeat a simple selector, but it's only one bit.
+        self._sibbits = tuple(sum(1 << i for i, sib in enumerate(sibs)
+                                  if sib in st.sibs)
+                              for st in states)
+        self._program = program
+        self._trans = {}
+        self._given = {}
+
+    def siblings(self, parent, code, ctx):
+        '''Returns a mask of the sibling selectors matched by parent's children.'''
+        if code == _ARRAY:
+            tot = len(parent)
+            children = ((None, num, tot, child)
+                        for num, child in enumerate(parent))
+        else:
+            children = ((Id, None, None, child)
+                        for Id, child in iteritems(parent))
+        want = self._first - 1
+        facts = 0
+        for Id, num, tot, child in children:
+            ccode = _nodetypes.get(type(child)) or _typecode(child)
+            bit = 1
+            for test in self.sibs:
+                if not facts & bit and test(child, ccode, Id, num, tot, ctx):
+                    facts |= bit
+                bit <<= 1
+            if facts == want:
+                break
+        return facts
+
+    def given(self, facts):
+        '''Returns the (_StateSet, facts) to use for children, given the result
+        of siblings(). Fragments which can't match any of them are dropped.'''
+        try:
+            return self._given[facts]
+        except KeyError:
+            pass
+        states = [st for st, sibbits in zip(self.states, self._sibbits)
+                  if st.repeat or (facts & sibbits) == sibbits]
+        ss = self._program.stateset(states)
+        t = (ss, 0)
+        if ss is not None:
+            t = (ss, sum(1 << i for i, sib in enumerate(ss.sibs)
+                         if facts & (1 << self.sibs.index(sib))))
+        if len(self._given) < _MAX_TRANSITIONS:
+            self._given[facts] = t
+        return t
+
+    def step(self, node, code, Id, num, tot, ctx, facts=0):
+        '''Returns (whether node matched, the _StateSet for its children, the
+        _StateSet to search for below it if it's a subject candidate).
+
+        facts is the result of siblings() for the node's parent. For the states
+        of match_many(), "whether node matched" is the sorted tuple of the
+        selectors which it matched (or False).
+        '''
+        mask = facts
+        bit = self._first
+        for test in self.tests:
+            if test(node, code, Id, num, tot, ctx):
+                mask |= bit
+            bit <<= 1
+        try:
+            return self._trans[mask]
+        except KeyError:
+            pass
+
+        call = False
+        pending = []
+        tails = []
+        outs = set()
+        for st, bit, sibbits in zip(self.states, self._bits, self._sibbits):
+            if st.repeat:
+                pending.append(st)
+            if mask & bit and (mask & sibbits) == sibbits:
+                if st.tail is not None:
+                    tails.extend(st.tail.states)
+                elif st.next is None:
+                    call = True
+                    if st.out is not None:
+                        outs.add(st.out)
+                else:
+                    pending.append(st.next)
+        if call:
+            tails = []
+        if outs:
+            call = tuple(sorted(outs))
+        t = (call, self._program.stateset(pending),
+             self._program.stateset(tails))
+        if len(self._trans) < _MAX_TRANSITIONS:
+            self._trans[mask] = t
+        return t
+
+
+def _depth(states):
+    '''Returns how many levels below a node the _States tested against it can
+    reach, or None if there's no limit.'''
+    deepest = 0
+    for st in states:
+        level = 0
+        while st is not None:
+            if st.repeat:
+                return None
+            if st.tail is not None:
+                if st.tail.depth is None:
+                    return None
+                deepest = max(deepest, level + st.tail.depth)
+            st = st.next
+            if st is not None:
+                level += 1
+        deepest = max(deepest, level)
+    return deepest
+
+
+def _key(v):
+    '''Returns a hashable key for the structure of a parsed selector.'''
+    out = []
+    stack = [v]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, tuple):
+            out.append(v)
+        elif isinstance(v, dict):
+            out.append(('{', len(v)))
+            for k in sorted(v, reverse=True):
+                stack.append(v[k])
+                stack.append(('k', k))
+        elif isinstance(v, list):
+            out.append(('[', len(v)))
+            stack.extend(reversed(v))
         else:
-            mod = (num - cs['b']) % cs['a']
+            out.append((type(v), v))
+    return tuple(out)
 
-            m = not mod and ((num*cs['a'] + cs['b']) >= 0)
-    if m and cs.get('has'):
-        for el in cs['has']:
+
+class _Program(object):
+    '''Compiles parsed selectors into interned states.
+
+    Simple selectors and fragments which occur several times (e.g. the shared
+    suffix in ".a .c, .b .c") compile to a single state.
+    '''
+    def __init__(self):
+        self._simples = {}
+        self._states = {}
+        self._sets = {}
+
+    def initial(self, sel):
+        '''Returns the _StateSet for the start of a parsed selector.'''
+        frags = sel[1:] if (sel and sel[0] == ",") else [sel]
+        return self.stateset([self.state(f) for f in frags if f])
+
+    def selector(self, sel, string, out=None):
+        '''Like initial(), but for a whole selector, whose first "!" (if any)
+        marks the subject of each comma-separated part. out labels the states
+        which complete a match, for match_many().'''
+        frags = sel[1:] if (sel and sel[0] == ",") else [sel]
+        states = []
+        for frag in frags:
+            subj = None
+            for i, cs in enumerate(frag):
+                if isinstance(cs, dict) and cs.get('subject'):
+                    frag = frag[:i] + frag[i + 1:]
+                    subj = i
+                    break
+            if subj is not None and (subj == len(frag) or
+                                     not isinstance(frag[subj], dict)):
+                te("se", string)
+            if frag:
+                states.append(self.state(frag, subj, out))
+        return self.stateset(states)
+
+    def stateset(self, states):
+        if not states:
+            return None
+        key = frozenset(states)
+        ss = self._sets.get(key)
+        if ss is None:
+            seen = set()
+            unique = []
+            for st in states:
+                if st not in seen:
+                    seen.add(st)
+                    unique.append(st)
+            ss = _StateSet(tuple(unique), self)
+            if len(self._sets) < _MAX_STATE_SETS:
+                self._sets[key] = ss
+        return ss
+
+    def state(self, frag, subj=None, out=None):
+        '''Returns the _State for a fragment. subj is the index of its subject.'''
+        child = frag[0] == '>'
+        i = 1 if child else 0
+        # "A ~ B ~ C" matches a C whose parent also has children matching A
+        # and B. Whether it's a child or a descendant depends on the
+        # combinator before A.
+        sibs = []
+        while i != subj and i + 1 < len(frag) and frag[i + 1] == '~':
+            sibs.append(self.simple(frag[i]))
+            i += 2
+        rest = frag[i + 1:]
+        nxt = tail = None
+        if i == subj:
+            # "A !B ~ C ~ D" is B with siblings C and D; "A !B C" is B, if C
+            # can be found by the equivalent of B:has(C).
+            while rest and rest[0] == '~':
+                cs = rest[1]
+                rest = rest[2:]
+                if rest and rest[0] != '~':
+                    cs = dict(cs, has=(cs.get('has') or []) + [_hasTail(rest)])
+                    rest = []
+                sibs.append(self.simple(cs))
+            if rest:
+                tail = self.initial(_hasTail(rest))
+        elif rest:
+            nxt = self.state(rest, None if subj is None else subj - i - 1, out)
+        if nxt is not None:
+            out = None
+        simple = self.simple(frag[i])
+        repeat = not child and not (simple.root and not sibs)
+        key = (simple, repeat, nxt, tuple(sibs), tail, out)
+        st = self._states.get(key)
+        if st is None:
+            st = self._states[key] = _State(simple, repeat, nxt, tuple(sibs),
+                                            tail, out)
+        return st
+
+    def simple(self, cs):
+        '''Returns the _Simple for a parsed simple selector.'''
+        key = _key(cs)
+        simple = self._simples.get(key)
+        if simple is None:
+            simple = self._simples[key] = _Simple(cs, self)
+        return simple
+
+
+def _hasTail(rest):
+    '''Returns the :has() fragment for the part of a selector after its subject.'''
+    if rest[0] == '>':
+        return [{'pc': ':root'}] + rest
+    return rest
+
+
+def _subjectRuns(down, parent, code, ctx):
+    '''Returns the subject searches to run over parent's children.
+
+    down is a list of (_StateSet, candidates) pairs. Searches in the same state
+    are merged, and candidates which have already been found are dropped.
+    '''
+    if len(down) == 1 and not down[0][0].sibs:
+        ss, cands = down[0]
+        if len(cands) == 1:
+            return ((ss, 0, cands),)
+    merged = {}
+    for ss, cands in down:
+        live = [cand for cand in cands if not cand[0]]
+        if live:
+            merged.setdefault(ss, []).extend(live)
+    runs = []
+    for ss, cands in iteritems(merged):
+        facts = 0
+        if ss.sibs:
+            ss, facts = ss.given(ss.siblings(parent, code, ctx))
+        if ss is not None:
+            runs.append((ss, facts, cands))
+    return runs
+
+
+def _lookup(obj, keys):
+    '''Returns the (key, value) pairs of a dict for the given keys, in the
+    dict's own order.'''
+    hits = [k for k in keys if k in obj]
+    if len(hits) > 1:
+        # only the dict knows its order: scan it until all the keys turn up.
+        want = set(hits)
+        hits = []
+        for k in obj:
+            if k in want:
+                hits.append(k)
+                if len(hits) == len(want):
+                    break
+    return [(k, obj[k]) for k in hits]
+
+
+def _elements(arr, nths, deep, scalars=True):
+    '''Returns the (index, element) pairs of an array which may pass any of
+    the _Simples' :nth-child tests, in order. If deep, then all the elements
+    which are containers are included, too. Unless scalars is set, only
+    containers are included at all.'''
+    tot = len(arr)
+    if len(nths) == 1:
+        indices = nths[0].indices(tot)
+    else:
+        indices = sorted(set().union(*[simple.indices(tot) for simple in nths]))
+    if not deep:
+        elements = ((i, arr[i]) for i in indices)
+        return elements if scalars else _containers(elements)
+    if not scalars:
+        return _containers(enumerate(arr))
+    wanted = set(indices)
+    return ((i, el) for i, el in enumerate(arr)
+            if i in wanted or
+            (_nodetypes.get(type(el)) or _typecode(el)) in (_ARRAY, _OBJECT))
+
+
+def _containers(children):
+    '''Filters (key or index, child) pairs down to the children which are
+    arrays or objects.'''
+    return ((k, child) for k, child in children
+            if (_nodetypes.get(type(child)) or _typecode(child)) >= _ARRAY)
+
+
+def _found(runs):
+    '''Have all the candidates of these subject searches been found?'''
+    for ss, facts, cands in runs:
+        for cand in cands:
+            if not cand[0]:
+                return False
+    return True
+
+
+class _WalkOptions(object):
+    '''What _forEach() yields, and the ways in which it prunes its search.
+
+    If tagged, (selectors, node) pairs are yielded instead of nodes, where
+    selectors is the tuple of match_many() selectors which the node matched.
+    If paths, (path, node) pairs are yielded, where path is the tuple of keys
+    and indices leading to the node from the object being walked.
+
+    If early, each node is yielded as soon as it's known to match, i.e. before
+    its descendants rather than after them. Except for the subjects of "A !B C",
+    which still wait for their searches, that's document order.
+
+    bailout_fn only prunes the main search, as do the other ways of pruning it:
+
+        split: the states are from _compileMany(), for the selector (0) and a
+            prune selector (1). Nodes which match the selector are yielded, and
+            the search doesn't go below nodes which match the prune selector.
+        max_depth: the search doesn't go more than this many levels below the
+            object.
+        prune_on_match: the search doesn't go below the nodes which match.
+
+    delegate is called for each container whose children are to be searched,
+    as delegate(path, container, code, _StateSet, facts, children), where
+    children is the iterator of (key or index, child) pairs which would be
+    searched. It may take over the search by returning an iterable of the
+    matches among the children's subtrees, in order, or return None (without
+    touching children) to leave it to the walk.
+    '''
+    __slots__ = ('tagged', 'paths', 'early', 'split', 'max_depth',
+                 'prune_on_match', 'delegate')
+
+    def __init__(self, tagged=False, paths=False, early=False, split=False,
+                 max_depth=None, prune_on_match=False, delegate=None):
+        self.tagged = tagged
+        self.paths = paths
+        self.early = early
+        self.split = split
+        self.max_depth = max_depth
+        self.prune_on_match = prune_on_match
+        self.delegate = delegate
+
+
+_PLAIN = _WalkOptions()
+_EARLY = _WalkOptions(early=True)
+_TAGGED = _WalkOptions(tagged=True)
+_PATHS = _WalkOptions(paths=True)
+
+
+def _forEach(states, obj, Id=None, num=None, tot=None, bailout_fn=None,
+             ctx=None, stats=None, facts=0, opts=_PLAIN):
+    '''Yields the nodes of obj which match a _StateSet, in post-order.
+
+    This walks the tree with an explicit stack rather than with a generator per
+    level, so each match is only yielded once (not once per ancestor) and deep
+    documents don't run into the recursion limit.
+
+    The subject of "A !B C" is matched in the same walk: when a B is found, the
+    search for C below it is run alongside the main search (or by itself, if
+    the main search has nothing to look for below B), and the B is yielded in
+    its usual place if it turns anything up.
+
+    facts is the result of siblings() for obj's parent, if obj isn't the root.
+    opts is a _WalkOptions, for the rest of what the walk can do. If a Stats is
+    given (or ctx has one), the work done is counted in it.
+    '''
+    if states is None:
+        return
+    if ctx is None:
+        ctx = _Context(stats)
+    stats = ctx.stats
+    tagged, paths, early = opts.tagged, opts.paths, opts.early
+    split, max_depth = opts.split, opts.max_depth
+    prune_on_match, delegate = opts.prune_on_match, opts.delegate
+    limited = split or max_depth is not None or prune_on_match
+    # the keys and indices leading to the current node, if they're wanted.
+    trail = [] if paths or delegate is not None else None
+    # (_StateSet, facts, candidates) for each subject search. A candidate is a
+    # one-element list: whether its search has found anything yet.
+    runs = ()
+    # One entry per container being descended into:
+    # (container, whether it matched, its subject candidate or None,
+    #  the _StateSet for its children, iterator over its children, its length
+    #  if it's an array, which of the _StateSet's sibling selectors its
+    #  children match, the subject searches for its children).
+    stack = []
+    while True:
+        code = _nodetypes.get(type(obj)) or _typecode(obj)
+        if stats is not None:
+            stats._visit(states, runs)
+        call = False
+        pending = tail = None
+        cut = None
+        if states is not None:
+            call, pending, tail = states.step(obj, code, Id, num, tot, ctx,
+                                              facts)
+            if limited:
+                if pending is None:
+                    pass
+                elif split and call and call[-1] == 1:
+                    pending, cut = None, 'prune'
+                elif max_depth is not None and len(stack) >= max_depth:
+                    pending, cut = None, 'max_depth'
+                elif prune_on_match and call and (not split or call[0] == 0):
+                    pending, cut = None, 'prune_on_match'
+                if split and call:
+                    call = call[0] == 0
+            if bailout_fn and bailout_fn(obj, call):
+                if pending is not None:
+                    cut = 'bailout'
+                pending = None
+            if early and call:
+                yield ((call, obj) if tagged else
+                       (tuple(trail), obj) if paths else obj)
+                call = False
+
+        down = None
+        if runs:
+            down = []
+            for ss, sfacts, cands in runs:
+                if len(cands) == 1 and cands[0][0]:
+                    continue
+                found, p, _ = ss.step(obj, code, Id, num, tot, ctx, sfacts)
+                if found:
+                    for cand in cands:
+                        cand[0] = True
+                elif p is not None:
+                    down.append((p, cands))
+        cand = None
+        if tail is not None and pending is None and not down:
+            # nothing else is going to look below the node, so search it now.
+            cand = [ctx.exists(tail, obj)]
+        elif tail is not None:
+            # like :has(), this starts by testing the candidate itself.
+            found, p, _ = tail.step(obj, code, None, None, None, ctx)
+            cand = [found]
+            if not found and p is not None:
+                down = (down or []) + [(p, [cand])]
+
+        if code == _ARRAY or code == _OBJECT and obj:
+            facts = 0
+            if pending is not None and pending.sibs:
+                pending, facts = pending.given(pending.siblings(obj, code, ctx))
+            runs = _subjectRuns(down, obj, code, ctx) if down else ()
+        else:
+            pending = None
+            runs = ()
+
+        keys = nths = None
+        scalars = True
+        if pending is not None and not runs:
+            scalars = code in pending.scalars
+            if code == _ARRAY:
+                nths = pending.nths
+                if nths == () and not pending.deep:
+                    pending = None
+            else:
+                keys = pending.keys
+                if keys == ():
+                    pending = None
+
+        if stats is not None and obj and code >= _ARRAY and not runs:
+            stats._skipped(code, states, pending, cut, keys, nths,
+                           scalars)
+
+        if pending is None and not runs:
+            if call or cand and cand[0]:
+                yield ((call, obj) if tagged else
+                       (tuple(trail), obj) if paths else obj)
+        else:
+            if nths is not None:
+                children = _elements(obj, nths, pending.deep, scalars)
+                length = len(obj)
+            elif code == _ARRAY:
+                children = enumerate(obj)
+                if not scalars:
+                    children = _containers(children)
+                length = len(obj)
+            elif keys is not None:
+                children = iter(_lookup(obj, keys))
+                length = None
+            else:
+                children = iteritems(obj)
+                if not scalars:
+                    children = _containers(children)
+                children = iter(children)
+                length = None
+            if delegate is not None and not runs:
+                found = delegate(tuple(trail), obj, code, pending, facts,
+                                 children)
+                if found is not None:
+                    for v in found:
+                        yield v
+                    children = iter(())
+            stack.append((obj, call, cand, pending, children, length, facts,
+                          runs))
+            if trail is not None:
+                trail.append(None)
+
+        # Move on to the next node, finishing off any exhausted containers.
+        while stack:
+            (parent, pcall, pcand, states, children, length, facts,
+             runs) = stack[-1]
             try:
-                next(_forEach(el, node))
-                continue
+                if states is None and _found(runs):
+                    raise StopIteration
+                k, obj = next(children)
             except StopIteration:
-                pass
-            m = False
+                stack.pop()
+                if trail is not None:
+                    trail.pop()
+                if pcall or pcand and pcand[0]:
+                    yield ((pcall, parent) if tagged else
+                           (tuple(trail), parent) if paths else parent)
+                continue
+            if trail is not None:
+                trail[-1] = k
+            if length is None:
+                Id, num, tot = k, None, None
+            else:
+                Id, num, tot = None, k, length
             break
-    if m and cs.get('expr'):
-        m = exprEval(cs['expr'], node)
+        else:
+            return
+
+
+def _hasSubject(states):
+    '''Can any of the _StateSet's fragments, or the ones after them, match
+    the subject of "A !B C"?'''
+    stack = list(states.states) if states is not None else []
+    seen = set()
+    while stack:
+        st = stack.pop()
+        if st in seen:
+            continue
+        seen.add(st)
+        if st.tail is not None:
+            return True
+        if st.next is not None:
+            stack.append(st.next)
+    return False
+
+
+def _pruneFirst(prune, obj, bailout_fn):
+    '''Returns a bailout_fn which prunes the nodes of obj matching the prune
+    Selector, as well as the ones which bailout_fn prunes.'''
+    pruned = set(id(v) for v in prune.match(obj))
+
+    def bail(node, matches):
+        return id(node) in pruned or bool(bailout_fn and
+                                          bailout_fn(node, matches))
+    return bail
+
+
+Analysis = namedtuple('Analysis', ['max_depth', 'fragments'])
+
+
+def _analyze(states):
+    '''Returns the Analysis of a _StateSet, for Selector.analyze().'''
+    if states is None:
+        return Analysis(0, ())
+    fragments = []
+    stack = list(reversed(states.states))
+    seen = set()
+    while stack:
+        st = stack.pop()
+        if st in seen:
+            continue
+        seen.add(st)
+        for simple in (st.simple,) + tuple(st.sibs):
+            fragment = (_describe(simple), st.repeat)
+            if fragment not in fragments:
+                fragments.append(fragment)
+        if st.next is not None:
+            stack.append(st.next)
+        if st.tail is not None:
+            stack.extend(reversed(st.tail.states))
+    return Analysis(states.depth, tuple(fragments))
+
+
+def _first(states, obj, Id=None, num=None, tot=None):
+    '''Returns [the first node of obj in document order which matches the
+    _StateSet], or [] if there isn't one.'''
+    if not _hasSubject(states):
+        for v in _forEach(states, obj, Id, num, tot, opts=_EARLY):
+            return [v]
+        return []
+    # subjects are only known to match after their descendants have been
+    # searched, so find all the matches, then the first of them. A match which
+    # comes before the first one in post-order, in document order, has to be
+    # one of its ancestors: the first is the one with the shortest path.
+    first = best = None
+    for path, v in _forEach(states, obj, Id, num, tot, opts=_PATHS):
+        if first is None:
+            first, best = path, (path, v)
+        elif len(path) < len(best[0]) and first[:len(path)] == path:
+            best = (path, v)
+    return [best[1]] if best else []
 
-    # should we repeat this selector for descendants?
-    if sel[0] != ">" and sel[0].get('pc') != ":root":
-        sels.append(sel)
 
-    if m:
-        # is there a fragment that we should pass down?
-        if sel[0] == ">":
-            if len(sel) > 2:
-                m = False
-                sels.append(sel[2:])
-        elif len(sel) > 1:
-            m = False
-            sels.append(sel[1:])
-
-    return [m, sels]
-
-
-def _forEach(sel, obj, Id=None, num=None, tot=None, bailout_fn=None):
-    a = sel[1:] if (sel[0] == ",") else [sel]
-    a0 = []
-    call = False
-    i = 0
-    j = 0
-    k = None
-    x = None
-    for i in range(len(a)):
-        x = mn(obj, a[i], Id, num, tot)
-        if x[0]:
-            call = True
-        for v in x[1]:
-            a0.append(v)
-
-    skip_recursion = False
-    if bailout_fn:
-        if bailout_fn(obj, call):
-            skip_recursion = True
-
-    if not skip_recursion:
-        if len(a0) and _jsTypeof(obj) == "object":
-            if len(a0) >= 1:
-                a0 = [','] + a0
-            if isArray(obj):
-                for i, v in enumerate(obj):
-                    iterator = _forEach(a0, v, num=i, tot=len(obj), bailout_fn=bailout_fn)
-                    for o in iterator:
-                        yield o
-            else:
-                if obj:
-                    for k, v in iteritems(obj):
-                        iterator = _forEach(a0, v, Id=k, bailout_fn=bailout_fn)
-                        for o in iterator:
-                            yield o
+def interpolate(sel, arr):
+    '''Replaces the ? placeholders in sel with the values in arr, as JSON.
 
-    if call:
-        yield obj
+    The placeholders are all found before any values are put in, so a ? in a
+    value is never taken for one.
+    '''
+    parts = sel.split('?')
+    if len(parts) < len(arr) + 1:
+        raise ValueError("too many parameters supplied")
+    if len(parts) > len(arr) + 1:
+        raise ValueError("too few parameters supplied")
+    out = [parts[0]]
+    for value, part in zip(arr, parts[1:]):
+        out.append(json.dumps(value))
+        out.append(part)
+    return ''.join(out)
 
 
-def interpolate(sel, arr):
-    while '?' in sel:
-        s = arr[0]
-        if isinstance(s, stringtype):
-            s = json.dumps(s)
-        sel = sel.sub(r'\?', s, sel)
-        arr = arr[1:]
+# THE SELECTOR CACHE
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class _LRUCache(object):
+    '''A thread-safe, bounded mapping which evicts the least recently used key.'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            self._evict()
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._data))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+_cache = _LRUCache(512)
+
+
+def cache_info():
+    '''Returns hit/miss/eviction statistics for the compiled selector cache.'''
+    return _cache.info()
+
+
+def cache_clear():
+    '''Empties the compiled selector cache and resets its statistics.'''
+    _cache.clear()
+
+
+def set_cache_size(maxsize):
+    '''Sets the maximum number of compiled selectors to keep around.'''
+    _cache.resize(maxsize)
+
+
+def cache_save(path, selectors=None):
+    '''Writes compiled selectors to a file, for cache_load().
+
+    Args:
+        path: The file to write. It's replaced in one step, so processes
+             which are loading it at the same time see either the old or the
+             new contents.
+        selectors: The selectors (strings or compiled Selectors) to save. By
+             default, the ones in the compiled selector cache are saved.
+
+    Returns the number of selectors saved.
+    '''
+    if selectors is None:
+        sels = [v for k, v in _cache.items() if isinstance(v, Selector)]
+    else:
+        sels = [sel if isinstance(sel, Selector) else compile(sel)
+                for sel in selectors]
+    data = {
+        'version': __version__,
+        'selectors': [(sel.selector, sel._ast) for sel in sels]
+    }
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(data, f, 2)
+    getattr(os, 'replace', os.rename)(tmp, path)
+    return len(sels)
+
+
+def cache_load(path):
+    '''Adds the selectors saved by cache_save() to the compiled selector
+    cache, so that compile() and match() don't have to parse them again.
+
+    The cache is keyed by selector text. A file which is missing, unreadable,
+    or was written by another version of pyjsonselect is ignored. Only the
+    most recently saved selectors are kept if there are more than the cache
+    holds (see set_cache_size()). As with any pickle, only load files from a
+    trusted source.
+
+    Returns the number of selectors loaded.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    except Exception:
+        # a missing, truncated or otherwise corrupt file is just a cache miss.
+        return 0
+    if not isinstance(data, dict) or data.get('version') != __version__:
+        return 0
+    sels = data['selectors']
+    for selector, ast in sels:
+        _cache.put(selector, Selector._lazy(selector, ast))
+    return len(sels)
+
+
+def _restore(selector, ast):
+    '''Unpickles a Selector, reusing the cached one for its text if there is
+    one.'''
+    compiled = _cache.get(selector)
+    if compiled is None:
+        compiled = Selector._lazy(selector, ast)
+        _cache.put(selector, compiled)
+    return compiled
+
+
+# Selector._compiled, until its states have been built.
+_UNBUILT = object()
+
+
+class Selector(object):
+    '''A compiled JSONSelect selector. Use compile() to create one.
+
+    Selectors are immutable, so a single instance may be shared freely between
+    callers and threads. They can be pickled: only the parsed selector is
+    stored, and its states are built when it's first used after unpickling.
+    '''
+    __slots__ = ('selector', '_ast', '_compiled')
+
+    def __init__(self, selector, ast):
+        object.__setattr__(self, 'selector', selector)
+        object.__setattr__(self, '_ast', ast)
+        object.__setattr__(self, '_compiled',
+                           _Program().selector(ast, selector))
+
+    @classmethod
+    def _lazy(cls, selector, ast):
+        '''Returns a Selector for an already-checked parsed selector, without
+        building its states yet.'''
+        sel = object.__new__(cls)
+        object.__setattr__(sel, 'selector', selector)
+        object.__setattr__(sel, '_ast', ast)
+        object.__setattr__(sel, '_compiled', _UNBUILT)
+        return sel
+
+    @property
+    def _states(self):
+        states = self._compiled
+        if states is _UNBUILT:
+            # if two threads get here at once, they build equivalent states.
+            states = _Program().selector(self._ast, self.selector)
+            object.__setattr__(self, '_compiled', states)
+        return states
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Selector objects are immutable')
+
+    def __reduce__(self):
+        return (_restore, (self.selector, self._ast))
+
+    def __repr__(self):
+        return 'Selector(%r)' % self.selector
+
+    def match(self, obj, bailout_fn=None, stats=None, prune=None,
+              max_depth=None, prune_on_match=False):
+        '''Match this selector to an object, yielding the matched values.
+
+        See jsonselect.match() for a description of the other arguments.
+        '''
+        states = self._states
+        split = False
+        if prune is not None:
+            if isinstance(prune, Selector):
+                prune = prune.selector
+            items = ((0, self.selector), (1, prune))
+            compiled = _cache.get(items)
+            if compiled is None:
+                compiled = _compileMany(items)
+                _cache.put(items, compiled)
+            names, combined, singles = compiled
+            if not singles:
+                states, split = combined, True
+            else:
+                # selectors with a subject can't share a walk, so find what
+                # to prune first.
+                bailout_fn = _pruneFirst(compile(prune), obj, bailout_fn)
+        opts = _PLAIN
+        if split or max_depth is not None or prune_on_match:
+            opts = _WalkOptions(split=split, max_depth=max_depth,
+                                prune_on_match=prune_on_match)
+        return _forEach(states, obj, bailout_fn=bailout_fn, stats=stats,
+                        opts=opts)
+
+    def analyze(self):
+        '''Returns an Analysis of how this selector is matched.
+
+        max_depth is the deepest level below the root which the search can
+        visit (None if there's no limit; :has() searches from a node aren't
+        counted), and fragments lists the text of the
+        simple selectors which can be tested, with whether each is tested at
+        every level below where it starts (as for "A B") or just one (as for
+        "A > B"). The matcher uses the same information to skip the subtrees,
+        and scalars, which none of the pending fragments can match.
+        '''
+        return _analyze(self._states)
+
+    def exists(self, obj):
+        '''Does this selector match anything in obj? See jsonselect.exists().'''
+        for _ in _forEach(self._states, obj, opts=_EARLY):
+            return True
+        return False
+
+    def count(self, obj):
+        '''Returns the number of nodes in obj which this selector matches.'''
+        n = 0
+        for _ in _forEach(self._states, obj, opts=_EARLY):
+            n += 1
+        return n
+
+    def first(self, obj, default=None):
+        '''Returns the first match in obj, in document order, or default if
+        there isn't one. See jsonselect.first().'''
+        found = _first(self._states, obj)
+        return found[0] if found else default
+
+
+def compile(sel, arr=None):
+    '''Parse a selector into a reusable Selector object.
+
+    Args:
+        sel: The JSONSelect selector to compile (a string)
+        arr: If sel contains ? characters, then the values in this array will
+             be safely interpolated into the selector.
+    '''
     if arr:
-        raise ValueError("too many parameters supplied")
-    return sel
+        sel = interpolate(sel, arr)
+    compiled = _cache.get(sel)
+    if compiled is None:
+        # ~ and ! are compiled as is, rather than rewritten by normalize().
+        compiled = Selector(sel, _parse(sel, 0, None, {})[1])
+        _cache.put(sel, compiled)
+    return compiled
 
 
-def match(sel, obj, arr=None, bailout_fn=None):
+def match(sel, obj, arr=None, bailout_fn=None, stats=None, prune=None,
+          max_depth=None, prune_on_match=False):
     '''Match a selector to an object, yielding the matched values.
 
     Args:
-        sel: The JSONSelect selector to apply (a string)
+        sel: The JSONSelect selector to apply (a string or a compiled Selector)
         obj: The object against which to apply the selector
         arr: If sel contains ? characters, then the values in this array will
              be safely interpolated into the selector.
@@ -668,8 +2103,123 @@ def match(sel, obj, arr=None, bailout_fn=None):
              search for matches will be aborted below that node. The |matches|
              parameter indicates whether the node matched the selector. This is
              intended to be used as a performance optimization.
+        stats: A Stats object, in which to count the work done by the match.
+             This is intended for finding out why a selector is slow.
+        prune: A selector (a string or a compiled Selector). The search isn't
+             continued below the nodes which it matches. It's matched in the
+             same walk as sel, so this is cheaper than an equivalent
+             bailout_fn.
+        max_depth: If set, the search isn't continued more than this many
+             levels below obj (0 only tests obj itself).
+        prune_on_match: If True, the search isn't continued below the nodes
+             which match sel.
+
+    Like bailout_fn, the pruning options don't limit :has() searches, or the
+    searches for what follows the subject of "A !B C".
     '''
-    if arr:
-        sel = interpolate(sel, arr)
-    sel = parse(sel)[1]
-    return _forEach(sel, obj, bailout_fn=bailout_fn)
+    if not isinstance(sel, Selector):
+        sel = compile(sel, arr)
+    return sel.match(obj, bailout_fn=bailout_fn, stats=stats, prune=prune,
+                     max_depth=max_depth, prune_on_match=prune_on_match)
+
+
+def exists(sel, obj, arr=None):
+    '''Does the selector match anything in obj?
+
+    This stops as soon as a match is found: unlike match(), it doesn't have to
+    look below a matching container before reporting it.
+
+    Args:
+        sel: The JSONSelect selector to apply (a string or a compiled Selector)
+        obj: The object against which to apply the selector
+        arr: If sel contains ? characters, then the values in this array will
+             be safely interpolated into the selector.
+    '''
+    if not isinstance(sel, Selector):
+        sel = compile(sel, arr)
+    return sel.exists(obj)
+
+
+def count(sel, obj, arr=None):
+    '''Returns the number of nodes in obj which the selector matches.
+
+    The arguments are as for exists().
+    '''
+    if not isinstance(sel, Selector):
+        sel = compile(sel, arr)
+    return sel.count(obj)
+
+
+def first(sel, obj, arr=None, default=None):
+    '''Returns the first node in obj which the selector matches, or default if
+    there isn't one.
+
+    "First" is in document order, the order in which the nodes appear in JSON
+    text. A container comes before its descendants there, though match()
+    yields it after them, so this isn't always the first value which match()
+    would yield. The search stops as soon as the first match is found (except
+    for selectors with a subject, !, which have to be searched in full).
+
+    The other arguments are as for exists().
+    '''
+    if not isinstance(sel, Selector):
+        sel = compile(sel, arr)
+    return sel.first(obj, default)
+
+
+def _compileMany(items):
+    '''Compiles the (name, selector string) pairs for match_many().
+
+    Returns (names, _StateSet, [(name, Selector)]). The selectors without a
+    subject share the _StateSet, whose matches are tagged with their index in
+    names; the others are matched by themselves.
+    '''
+    program = _Program()
+    names = []
+    states = []
+    singles = []
+    for name, sel in items:
+        ast = _parse(sel, 0, None, {})[1]
+        frags = ast[1:] if (ast and ast[0] == ",") else [ast]
+        if any(isinstance(cs, dict) and cs.get('subject')
+               for frag in frags for cs in frag):
+            singles.append((name, compile(sel)))
+            continue
+        ss = program.selector(ast, sel, len(names))
+        names.append(name)
+        if ss is not None:
+            states.extend(ss.states)
+    return names, program.stateset(states), singles
+
+
+def match_many(selectors, obj):
+    '''Match several selectors to an object at once, yielding (name, value)
+    pairs.
+
+    The selectors are matched in a single walk over obj, and the simple
+    selectors which they have in common are only tested once per node. Values
+    are yielded in the same order as match() would yield them; a value which
+    matches several selectors is yielded once for each, in the order of
+    selectors. Selectors with a subject (!) are matched by themselves, after
+    the others.
+
+    Args:
+        selectors: A dict mapping names to JSONSelect selectors (strings or
+             compiled Selectors), or a list of (name, selector) pairs.
+        obj: The object against which to apply the selectors
+    '''
+    if isinstance(selectors, dict):
+        selectors = iteritems(selectors)
+    items = tuple((name, sel.selector if isinstance(sel, Selector) else sel)
+                  for name, sel in selectors)
+    compiled = _cache.get(items)
+    if compiled is None:
+        compiled = _compileMany(items)
+        _cache.put(items, compiled)
+    names, states, singles = compiled
+    for outs, value in _forEach(states, obj, opts=_TAGGED):
+        for out in outs:
+            yield names[out], value
+    for name, sel in singles:
+        for value in sel.match(obj):
+            yield name, value
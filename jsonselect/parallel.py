@@ -0,0 +1,175 @@
+'''Match a selector against a large object using several processes.
+
+Usage:
+
+    # the same values as jsonselect.match(), in the same order.
+    for v in jsonselect.parallel_match('.features > * > .properties', obj,
+                                       workers=4):
+        ...
+
+The object is walked as usual until the search reaches a container with many
+children, e.g. the "features" array of a GeoJSON FeatureCollection. Its
+children are then split into chunks, which are searched by a pool of worker
+processes, and the matches are put back together in document order.
+
+Each worker is given the compiled selector and the object when it starts. A
+chunk is described by the path to its container, the fragments pending there
+and the keys or indices of the children in it, so nothing else is copied, and
+the matches come back as paths to be looked up in obj: the values yielded are
+obj's own, as for match(). Where processes are started by forking (e.g. on
+Linux), the workers share obj rather than copying it.
+
+Since the worker is given the container's real length and the results of its
+sibling selectors (~), :nth-last-child and ~ work across chunks; :root can only
+match obj itself, which is never sent to a worker.
+
+This needs concurrent.futures (Python 3.7 or later); elsewhere, the search
+runs in this process. Containers below the subject of "A !B C", which are
+searched for C as well as for the selector, aren't split either.
+'''
+
+import os
+import sys
+from functools import reduce
+from operator import getitem
+
+from .jsonselect import (Selector, compile, _forEach, _WalkOptions, _ARRAY,
+                         _PATHS)
+
+if sys.version_info >= (3, 7):
+    from concurrent.futures import ProcessPoolExecutor
+else:
+    # no initializer argument before Python 3.7.
+    ProcessPoolExecutor = None
+
+# By default, containers are split into about this many chunks per worker...
+_CHUNKS_PER_WORKER = 4
+# ...but containers with no more children than this aren't split at all.
+_MIN_CHUNK = 64
+
+# The worker's (Selector, list of its _States, object), set by _initWorker().
+_worker = None
+
+
+def _allStates(states):
+    '''Returns the _States which can be pending during a search for the
+    _StateSet, in an order which is the same wherever the selector's
+    compiled.'''
+    out = []
+    seen = set()
+    for st in states.states:
+        while st is not None and st not in seen:
+            seen.add(st)
+            out.append(st)
+            st = st.next
+    return out
+
+
+def _initWorker(sel, obj):
+    global _worker
+    _worker = (sel, _allStates(sel._states), obj)
+
+
+def _runChunk(task):
+    '''Searches a chunk of a container's children in a worker. Returns the
+    paths to the matches from the container, in order.'''
+    path, indices, facts, code, keys = task
+    sel, states, container = _worker
+    for k in path:
+        container = container[k]
+    program = sel._states._program
+    pending = program.stateset([states[i] for i in indices])
+    out = []
+    if code == _ARRAY:
+        tot = len(container)
+        for k in keys:
+            for p, v in _forEach(pending, container[k], None, k, tot,
+                                 facts=facts, opts=_PATHS):
+                out.append((k,) + p)
+    else:
+        for k in keys:
+            for p, v in _forEach(pending, container[k], k, facts=facts,
+                                 opts=_PATHS):
+                out.append((k,) + p)
+    return out
+
+
+class _Splitter(object):
+    '''The delegate for _forEach() which hands big containers to the pool.'''
+
+    def __init__(self, sel, obj, workers, chunk_size):
+        self.sel = sel
+        self.obj = obj
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.index = None
+        self.pool = None
+
+    def __call__(self, path, container, code, pending, facts, children):
+        n = len(container)
+        size = self.chunk_size or max(
+            _MIN_CHUNK, -(-n // (self.workers * _CHUNKS_PER_WORKER)))
+        if n <= size:
+            return None
+        keys = [k for k, child in children]
+        if self.pool is None:
+            self.index = dict((st, i) for i, st in
+                              enumerate(_allStates(self.sel._states)))
+            self.pool = ProcessPoolExecutor(
+                self.workers, initializer=_initWorker,
+                initargs=(self.sel, self.obj))
+        indices = [self.index[st] for st in pending.states]
+        tasks = [(path, indices, facts, code, keys[i:i + size])
+                 for i in range(0, len(keys), size)]
+        return self.resolve(container, self.pool.map(_runChunk, tasks))
+
+    def resolve(self, container, results):
+        for paths in results:
+            for p in paths:
+                yield reduce(getitem, p, container)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def parallel_match(sel, obj, arr=None, workers=None, chunk_size=None):
+    '''Match a selector to an object using a pool of processes, yielding the
+    matched values in the same order as match() would.
+
+    Args:
+        sel: The JSONSelect selector to apply (a string or a compiled Selector)
+        obj: The object against which to apply the selector
+        arr: If sel contains ? characters, then the values in this array will
+             be safely interpolated into the selector.
+        workers: The number of processes to use (by default, one per CPU). With
+             1, or where they aren't supported, this is the same as match().
+        chunk_size: How many of a container's children to search in each
+             task. Containers with no more children than this are searched by
+             this process. By default, containers are split into a few chunks
+             per worker, if they have enough children.
+
+    The pool is started when the first container is split, and shut down when
+    the matches have all been yielded.
+    '''
+    if not isinstance(sel, Selector):
+        sel = compile(sel, arr)
+    if workers is not None and workers < 1:
+        raise ValueError('workers must be at least 1')
+    if ProcessPoolExecutor is not None and workers is None:
+        workers = os.cpu_count() or 1
+    if ProcessPoolExecutor is None or workers == 1:
+        return sel.match(obj)
+    return _parallel(sel, obj, _Splitter(sel, obj, workers, chunk_size))
+
+
+def _parallel(sel, obj, splitter):
+    '''Yields the matches for parallel_match(), shutting down the splitter's
+    pool when they've all been yielded.'''
+    try:
+        for v in _forEach(sel._states, obj,
+                          opts=_WalkOptions(delegate=splitter)):
+            yield v
+    finally:
+        splitter.close()
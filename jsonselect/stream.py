@@ -0,0 +1,333 @@
+'''Match selectors against JSON text as it's read, rather than after loading it.
+
+Usage:
+
+    # prints the names, without holding all of big.json in memory.
+    with open('big.json') as f:
+        for name in jsonselect.match_stream('.records > * > .name', f):
+            print name
+
+Matched values are yielded in the same order as match() would yield them, as
+soon as they've been read. Subtrees which no part of the selector can reach are
+skipped over without being decoded (or validated). Containers are only loaded
+into memory when they're needed whole: when they match, when :has(), :expr() or
+a subject (!) has to be tested against them, or when their children are tested
+with ~ or :nth-last-child. Objects are loaded as OrderedDicts.
+'''
+
+import codecs
+import json
+import re
+from collections import OrderedDict
+from json.decoder import scanstring
+from json.scanner import NUMBER_RE
+
+from .jsonselect import (PY3, Selector, compile, _first, _forEach, _nodetypes,
+                         _typecode, _ARRAY, _OBJECT, _EARLY)
+
+
+_ws = re.compile(r'[ \t\n\r]*')
+_token = re.compile(r'[^ \t\n\r,:\]}]*')
+_structure = re.compile(r'["\[\]{}]')
+# the rest of a string, after its opening quote.
+_stringEnd = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_constants = {
+    'true': True,
+    'false': False,
+    'null': None,
+    'NaN': float('nan'),
+    'Infinity': float('inf'),
+    '-Infinity': float('-inf')
+}
+
+# The length of an array which is being read, as passed to the matcher. Only
+# :nth-last-child needs the real length, and arrays whose elements are tested
+# against it are loaded whole.
+_UNKNOWN = -1
+
+
+class _Reader(object):
+    '''A window onto a file of JSON text.'''
+
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.offset = 0  # of buf in the file
+        self.start = None  # of the value being loaded, if any
+        self.decoder = None
+
+    def read(self):
+        '''Appends the next chunk of the file. Returns False at the end.
+
+        While a value longer than a chunk is being read (e.g. by load(), or a
+        long string), each chunk is as long as what's been read of it so far.
+        The text kept in buf is copied, and a string is scanned from its start,
+        once per read, so this keeps the total work linear in its length.
+        '''
+        keep = self.pos if self.start is None else self.start
+        data = self.fileobj.read(max(self.chunk_size, len(self.buf) - keep))
+        if not data:
+            return False
+        if PY3 and isinstance(data, bytes):
+            if self.decoder is None:
+                self.decoder = codecs.getincrementaldecoder('utf-8')()
+            data = self.decoder.decode(data)
+        self.buf = self.buf[keep:] + data
+        self.offset += keep
+        self.pos -= keep
+        if self.start is not None:
+            self.start = 0
+        return True
+
+    def error(self, msg):
+        raise ValueError('%s: char %d' % (msg, self.offset + self.pos))
+
+    def ws(self):
+        '''Skips whitespace, returning the next character ('' at the end).'''
+        if self.pos < len(self.buf):
+            c = self.buf[self.pos]
+            if c not in ' \t\n\r':
+                return c
+        while True:
+            self.pos = _ws.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read():
+                return ''
+
+    def string(self):
+        if self.ws() != '"':
+            self.error('Expecting property name enclosed in double quotes')
+        while not _stringEnd.match(self.buf, self.pos + 1):
+            if not self.read():
+                self.error('Unterminated string starting at')
+        s, self.pos = scanstring(self.buf, self.pos + 1)
+        return s
+
+    def scalar(self):
+        '''Reads a string, number, true, false or null.'''
+        if self.buf[self.pos] == '"':
+            return self.string()
+        while True:
+            end = _token.match(self.buf, self.pos).end()
+            if end < len(self.buf) or not self.read():
+                break
+        text = self.buf[self.pos:end]
+        if text in _constants:
+            value = _constants[text]
+        else:
+            m = NUMBER_RE.match(text)
+            if not m or m.end() != len(text):
+                self.error('Expecting value')
+            integer, frac, exp = m.groups()
+            if frac or exp:
+                value = float(integer + (frac or '') + (exp or ''))
+            else:
+                value = int(integer)
+        self.pos = end
+        return value
+
+    def skip(self):
+        '''Moves past the array or object at pos.'''
+        depth = 0
+        while True:
+            m = _structure.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                if not self.read():
+                    self.error('Unterminated value')
+                continue
+            c = m.group()
+            if c == '"':
+                self.pos = m.start()
+                while True:
+                    end = _stringEnd.match(self.buf, self.pos + 1)
+                    if end:
+                        break
+                    if not self.read():
+                        self.error('Unterminated string starting at')
+                self.pos = end.end()
+                continue
+            self.pos = m.end()
+            if c == '[' or c == '{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def load(self):
+        '''Reads the array or object at pos.'''
+        self.start = self.pos
+        self.skip()
+        text = self.buf[self.start:self.pos]
+        self.start = None
+        return json.loads(text, object_pairs_hook=OrderedDict)
+
+
+class _Plan(object):
+    '''What a _StateSet needs of the values it's tested against.'''
+    __slots__ = ('value', 'whole')
+
+    def __init__(self, states):
+        simples = []
+        for st in states.states:
+            if st.simple not in simples:
+                simples.append(st.simple)
+        # the simple selectors which can't be tested without the value.
+        self.value = tuple(simple for simple in simples
+                           if simple.has or simple.expr is not None)
+        # do the children need to be tested as a whole?
+        self.whole = bool(states.sibs) or any(
+            simple.nth == ':nth-last-child' for simple in simples)
+
+
+def match_stream(sel, fileobj, arr=None, chunk_size=65536):
+    '''Match a selector to the JSON text in a file, yielding the matched values.
+
+    Args:
+        sel: The JSONSelect selector to apply (a string or a compiled Selector)
+        fileobj: A file-like object with a read() method, returning JSON text
+             (either str or UTF-8 encoded bytes).
+        arr: If sel contains ? characters, then the values in this array will
+             be safely interpolated into the selector.
+        chunk_size: How much text to read at a time.
+    '''
+    return _stream(sel, fileobj, arr, chunk_size, _forEach)
+
+
+def exists_stream(sel, fileobj, arr=None, chunk_size=65536):
+    '''Does the selector match anything in the JSON text in a file?
+
+    Like jsonselect.exists(), this stops reading as soon as it finds a match.
+    The arguments are as for match_stream().
+    '''
+    for _ in _stream(sel, fileobj, arr, chunk_size, _early):
+        return True
+    return False
+
+
+def count_stream(sel, fileobj, arr=None, chunk_size=65536):
+    '''Returns the number of values in the JSON text in a file which the
+    selector matches. The arguments are as for match_stream().'''
+    n = 0
+    for _ in _stream(sel, fileobj, arr, chunk_size, _early):
+        n += 1
+    return n
+
+
+def first_stream(sel, fileobj, arr=None, chunk_size=65536, default=None):
+    '''Returns the first value in the JSON text in a file which the selector
+    matches, or default if there isn't one.
+
+    Like jsonselect.first(), "first" is in document order, and this stops
+    reading as soon as it's found. The other arguments are as for
+    match_stream().
+    '''
+    for v in _stream(sel, fileobj, arr, chunk_size, _first):
+        return v
+    return default
+
+
+def _early(states, value, Id, num, tot):
+    return _forEach(states, value, Id, num, tot, opts=_EARLY)
+
+
+def _stream(sel, fileobj, arr, chunk_size, walk):
+    '''Matches sel against the JSON text in a file, using
+    walk(states, value, Id, num, tot) for the values which have to be matched
+    as a whole, and yielding what it yields.
+
+    Those values are never nested inside each other, and the file is read in
+    order, so if walk yields matches in document order, so does this.
+    '''
+    if not isinstance(sel, Selector):
+        sel = compile(sel, arr)
+    reader = _Reader(fileobj, chunk_size)
+    plans = {}
+    states, Id, num, tot = sel._states, None, None, None
+    # [type code, _StateSet for the children, number of children so far] for
+    # each container which is being read through.
+    stack = []
+    while True:
+        c = reader.ws()
+        if not c:
+            reader.error('Expecting value')
+        if states is None:
+            if c == '[' or c == '{':
+                reader.skip()
+            else:
+                reader.scalar()
+        elif c == '[' or c == '{':
+            code = _ARRAY if c == '[' else _OBJECT
+            plan = plans.get(states)
+            if plan is None:
+                plan = plans[states] = _Plan(states)
+            load = any(simple.shallow(code, Id, num, tot)
+                       for simple in plan.value)
+            if not load:
+                call, pending, tail = states.step(None, code, Id, num, tot,
+                                                  None)
+                if call or tail is not None:
+                    load = True
+                elif pending is not None:
+                    plan = plans.get(pending)
+                    if plan is None:
+                        plan = plans[pending] = _Plan(pending)
+                    load = plan.whole
+            if load:
+                # the has() memo is keyed by id(), so each value which is
+                # loaded needs its own.
+                for v in walk(states, reader.load(), Id, num, tot):
+                    yield v
+            elif pending is None:
+                reader.skip()
+            else:
+                reader.pos += 1
+                stack.append([code, pending, 0])
+        else:
+            value = reader.scalar()
+            code = _nodetypes.get(type(value)) or _typecode(value)
+            plan = plans.get(states)
+            if plan is None:
+                plan = plans[states] = _Plan(states)
+            if plan.value:
+                for v in walk(states, value, Id, num, tot):
+                    yield v
+            else:
+                call, pending, tail = states.step(value, code, Id, num, tot,
+                                                  None)
+                if call:
+                    yield value
+                elif tail is not None:
+                    for v in walk(states, value, Id, num, tot):
+                        yield v
+
+        # Move on to the next value, finishing off any containers.
+        while stack:
+            frame = stack[-1]
+            code, states, n = frame
+            c = reader.ws()
+            if c == (']' if code == _ARRAY else '}'):
+                reader.pos += 1
+                stack.pop()
+                continue
+            if n:
+                if c != ',':
+                    reader.error("Expecting ',' delimiter")
+                reader.pos += 1
+            frame[2] = n + 1
+            if code == _ARRAY:
+                Id, num, tot = None, n, _UNKNOWN
+            else:
+                Id, num, tot = reader.string(), None, None
+                if reader.ws() != ':':
+                    reader.error("Expecting ':' delimiter")
+                reader.pos += 1
+            break
+        else:
+            if reader.ws():
+                reader.error('Extra data')
+            return
@@ -1,13 +1,26 @@
+import os
+import re
+
 from setuptools import setup, find_packages
 
+
+def version():
+    '''Reads __version__ from the package, without importing it.'''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'jsonselect', 'jsonselect.py')
+    with open(path) as f:
+        return re.search(r"^__version__ = '([^']+)'", f.read(), re.M).group(1)
+
+
 setup(name='pyjsonselect',
-      version='0.2.2',
+      version=version(),
       description='Fully-compliant implementation of JSONSelect',
       author='Dan Vanderkam',
       author_email='danvdk@gmail.com',
       url='https://github.com/danvk/pyjsonselect/',
       packages=['jsonselect'],
       install_requires=[],
+      extras_require={'numpy': ['numpy']},
       classifiers=[
           'Development Status :: 4 - Beta',
           'Intended Audience :: Developers',
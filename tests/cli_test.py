@@ -2,6 +2,8 @@ from nose.tools import *
 
 import cli
 import json
+import os
+from collections import OrderedDict
 
 
 def test_filter_object():
@@ -21,3 +23,83 @@ def test_filter_object():
     obj = {'foo': ['bar', {'baz': 'quux'}]}
     cli.filter_object(obj, {id(obj['foo'][1]): cli.DELETE}, presumption=cli.KEEP)
     eq_({'foo': ['bar']}, obj)
+
+
+def test_ndjson():
+    import io
+    import tempfile
+    records = ['{"a": %d, "b": {"c": "x%d"}}' % (i, i) for i in range(2500)]
+    f = tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False)
+    f.write('\n'.join(records[:1200]) + '\n\n' + '\n'.join(records[1200:]) + '\n')
+    f.close()
+
+    try:
+        expected = ''.join('"x%d"\n' % i for i in range(2500))
+        for jobs in ['1', '3']:
+            out = io.StringIO()
+            cli.run(['--ndjson', '--jobs', jobs, '--ordered', '.c', f.name], out)
+            eq_(expected, out.getvalue())
+
+        # without --ordered, chunks come back in any order.
+        out = io.StringIO()
+        cli.run(['--ndjson', '--jobs', '3', '-v', '.b', f.name], out)
+        eq_(sorted('{"a":%d}' % i for i in range(2500)),
+            sorted(out.getvalue().splitlines()))
+    finally:
+        os.unlink(f.name)
+
+
+def test_plan_actions():
+    eq_([[('-k', '.a'), ('-v', '.b'), ('', '.c')]],
+        cli.plan_actions([('-k', '.a'), ('-v', '.b'), ('', '.c')]))
+    # selectors which depend on siblings or descendants start a new pass.
+    eq_([[('-k', '.a')], [('-v', ':has(.b)')], [('-k', ':first-child')]],
+        cli.plan_actions([('-k', '.a'), ('-v', ':has(.b)'),
+                          ('-k', ':first-child')]))
+    # as does anything after a select.
+    eq_([[('', '.a')], [('-k', '.b')]],
+        cli.plan_actions([('', '.a'), ('-k', '.b')]))
+
+
+def test_fused_pass():
+    obj = {'a': {'b': 1, 'c': [2, 3]}, 'd': {'b': 4}}
+    eq_([{'a': {'c': [2, 3]}}],
+        cli.apply_actions([obj], [('-k', '.a'), ('-v', '.b')]))
+    eq_([2, 3], cli.apply_actions([{'a': {'b': 1, 'c': [2, 3]}}],
+                                  [('-v', '.b'), ('', 'number')]))
+    eq_([1, 2], cli.apply_actions([{'a': 1}, {'a': 2}], [('', '.a')]))
+    # knocking out the root leaves it alone.
+    eq_([{'x': 1}], cli.apply_actions([{'x': 1}], [('-v', ':root')]))
+
+
+def test_json_writer():
+    obj = OrderedDict([('a', [1.0, 2.5, u'é']), ('b', {}), ('c', None)])
+    for mode, expected in [
+            (cli.PRETTY, json.dumps(obj, indent=2, separators=(',', ': '),
+                                    ensure_ascii=False).replace('1.0', '1')),
+            (cli.COMPACT, u'{"a": [1, 2.5, "é"], "b": {}, "c": null}'),
+            (cli.NDJSON, u'{"a":[1,2.5,"é"],"b":{},"c":null}')]:
+        parts = []
+        writer = cli.JSONWriter(parts.append, mode)
+        writer.write(obj)
+        writer.write(True)
+        eq_([], parts)  # nothing is written until the buffer fills up.
+        writer.flush()
+        eq_(expected + '\ntrue\n', ''.join(parts))
+
+    # a small buffer is written out in pieces.
+    parts = []
+    writer = cli.JSONWriter(parts.append, cli.NDJSON, buffer_size=4)
+    writer.write(list(range(10)))
+    writer.flush()
+    eq_('[0,1,2,3,4,5,6,7,8,9]\n', ''.join(parts))
+    ok_(len(parts) > 3)
+
+    assert_raises(ValueError, cli.JSONWriter, parts.append, 'xml')
+
+
+def test_output_modes():
+    eq_('[1,1.234,2,-4,-4.0000001]\n',
+        cli.run(['--output', 'ndjson', '.', 'tests/cli/floats.json']))
+    eq_('[1, 1.234, 2, -4, -4.0000001]\n',
+        cli.run(['--output', 'compact', '.', 'tests/cli/floats.json']))
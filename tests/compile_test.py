@@ -0,0 +1,161 @@
+from nose.tools import *
+
+import jsonselect
+from jsonselect import jsonselect as js
+
+
+def test_compile():
+    sel = jsonselect.compile('.foo')
+    eq_('.foo', sel.selector)
+    eq_([1, 2], list(sel.match({'foo': 1, 'bar': {'foo': 2}})))
+    # compiled selectors can be reused and passed to match().
+    eq_([3], list(sel.match([{'foo': 3}])))
+    eq_([3], list(jsonselect.match(sel, [{'foo': 3}])))
+
+
+def test_immutable():
+    sel = jsonselect.compile('.foo')
+    with assert_raises(AttributeError):
+        sel.selector = '.bar'
+
+
+def test_interpolate():
+    eq_(['b'], list(jsonselect.match('.a:val(?)', {'a': 'b'}, ['b'])))
+    eq_([2], list(jsonselect.match('.a:expr(x = ?)', {'a': 2}, [2])))
+    eq_('.a:val("b")', jsonselect.compile('.a:val(?)', ['b']).selector)
+    with assert_raises(ValueError):
+        jsonselect.compile('.a', ['b'])
+    # a ? in a value isn't another placeholder.
+    eq_('."a?b" > ."c"', js.interpolate('.? > .?', ['a?b', 'c']))
+    eq_(['x'], list(jsonselect.match('.? > .?', {'a?b': {'c': 'x'}},
+                                     ['a?b', 'c'])))
+    with assert_raises(ValueError):
+        jsonselect.compile('.a:val(?) ~ .b:val(?)', ['b'])
+    # values are written as JSON.
+    eq_(':expr(x = true) :expr(x = null)',
+        js.interpolate(':expr(x = ?) :expr(x = ?)', [True, None]))
+    eq_([True], list(jsonselect.match('.a:expr(x = ?)', {'a': True}, [True])))
+
+
+def test_cache():
+    jsonselect.cache_clear()
+    a = jsonselect.compile('.foo')
+    b = jsonselect.compile('.foo')
+    ok_(a is b)
+    list(jsonselect.match('.foo', {}))
+    eq_((2, 1, 0), jsonselect.cache_info()[:3])
+
+
+def test_cache_eviction():
+    jsonselect.cache_clear()
+    jsonselect.set_cache_size(2)
+    try:
+        jsonselect.compile('.a')
+        jsonselect.compile('.b')
+        jsonselect.compile('.a')  # .b is now the least recently used
+        jsonselect.compile('.c')
+        info = jsonselect.cache_info()
+        eq_(1, info.evictions)
+        eq_(2, info.currsize)
+        jsonselect.compile('.a')
+        eq_(2, jsonselect.cache_info().hits)
+        jsonselect.compile('.b')
+        eq_(4, jsonselect.cache_info().misses)
+    finally:
+        jsonselect.set_cache_size(512)
+
+
+def test_errors_not_cached():
+    jsonselect.cache_clear()
+    for _ in range(2):
+        with assert_raises(js.JsonSelectError):
+            jsonselect.compile('.foo >')
+    eq_(0, jsonselect.cache_info().currsize)
+
+
+def test_shared_fragments():
+    # the shared suffix of a union compiles to a single state.
+    states = js._Program().initial(js.parse('.a .c, .b .c')[1]).states
+    eq_(2, len(states))
+    ok_(states[0].next is states[1].next)
+
+    # descendant fragments don't pile up as the search descends.
+    sel = jsonselect.compile('* * .c')
+    obj = {'c': 0}
+    for i in range(50):
+        obj = {'a': obj}
+    states = sel._states
+    node, key = obj, None
+    while 'a' in node:
+        ctx = js._Context()
+        states = states.step(node, js._OBJECT, key, None, None, ctx)[1]
+        eq_(len(states.states), len(set(states.states)))
+        ok_(len(states.states) <= 3)
+        node, key = node['a'], 'a'
+    eq_([0], list(sel.match(obj)))
+
+
+def test_simple_selectors():
+    sel = js._Program().initial(js.parse('string.foo:nth-last-child(2n+1)')[1])
+    simple = sel.states[0].simple
+    eq_(js._STRING, simple.type)
+    eq_('foo', simple.id)
+    ok_(simple.match('x', js._STRING, 'foo', 2, 3, None))
+    ok_(not simple.match('x', js._STRING, 'foo', 1, 3, None))
+    ok_(not simple.match('x', js._STRING, 'foo', None, None, None))
+    ok_(not simple.match(1, js._NUMBER, 'foo', 2, 3, None))
+
+    # interned, so equal simple selectors are only tested once per node.
+    sel = js._Program().initial(js.parse('.a .b, .a .c')[1])
+    eq_(1, len(sel.tests))
+
+
+def test_pickle():
+    import pickle
+    obj = {'a': [1, 'b', {'a': 2}]}
+    for text in ['.a', 'number:expr(x > 1)', '.a:val("b")', '!object > .a']:
+        sel = jsonselect.compile(text)
+        jsonselect.cache_clear()
+        copy = pickle.loads(pickle.dumps(sel, 2))
+        eq_(text, copy.selector)
+        eq_(list(sel.match(obj)), list(copy.match(obj)))
+        # unpickled selectors are cached, like compiled ones.
+        ok_(jsonselect.compile(text) is copy)
+        ok_(pickle.loads(pickle.dumps(sel, 2)) is copy)
+
+    # so are parsed expressions, which use Undefined for x.
+    ast = js.parse(':expr(x = 1)')
+    ok_(pickle.loads(pickle.dumps(ast, 2))[1][0]['expr'][0] is js.Undefined)
+
+
+def test_disk_cache():
+    import os
+    import pickle
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'selectors.cache')
+    try:
+        eq_(0, jsonselect.cache_load(path))
+        jsonselect.cache_clear()
+        jsonselect.compile('.a')
+        jsonselect.compile('.b > number')
+        eq_(2, jsonselect.cache_save(path))
+        eq_(1, jsonselect.cache_save(path + '.1', ['.c']))
+
+        jsonselect.cache_clear()
+        eq_(2, jsonselect.cache_load(path))
+        eq_(2, jsonselect.cache_info().currsize)
+        eq_([2], list(jsonselect.match('.b > number', {'b': [2, 'x']})))
+        eq_((1, 0), jsonselect.cache_info()[:2])
+
+        # caches from other versions, and broken files, are ignored.
+        with open(path, 'wb') as f:
+            pickle.dump({'version': '0.0.1', 'selectors': [('.a', None)]}, f)
+        eq_(0, jsonselect.cache_load(path))
+        with open(path, 'wb') as f:
+            f.write(b'\x80\x02}q')
+        eq_(0, jsonselect.cache_load(path))
+    finally:
+        shutil.rmtree(tmp)
+        jsonselect.cache_clear()
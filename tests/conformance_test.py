@@ -3,11 +3,12 @@ import os
 import re
 import sys
 import json
+from unittest import SkipTest
 
 from nose.tools import *
 
 from tests.utils import jsonLoadOrdered
-from jsonselect import jsonselect
+from jsonselect import columns, document, jsonselect
 
 
 # Set to something truthy to filter conformance tests.
@@ -28,7 +29,7 @@ def _fileTuples(path):
     return tuples
 
 
-def _runTests(path):
+def _runTests(path, engine=None):
     for i, (json_path, selector_path, output_path) in enumerate(_fileTuples(path)):
         if DEBUG_FILTER and DEBUG_FILTER not in selector_path:
             continue
@@ -38,7 +39,10 @@ def _runTests(path):
 
         outputs = []
         try:
-            items = jsonselect.match(selector, data)
+            if engine:
+                items = document.Document(data, engine).match(selector)
+            else:
+                items = jsonselect.match(selector, data)
             actual_output = '\n'.join([json.dumps(o, indent=4) for o in items])
             
         except jsonselect.JsonSelectError as e:
@@ -69,3 +73,11 @@ def test_level4():
 
 def test_extensions():
     _runTests('tests/extensions')
+
+
+def test_numpy_engine():
+    if columns.numpy is None:
+        raise SkipTest('NumPy is not installed')
+    for path in ['tests/spec/level_1', 'tests/spec/level_2',
+                 'tests/spec/level_3', 'tests/level_4', 'tests/extensions']:
+        _runTests(path, engine='numpy')
@@ -0,0 +1,82 @@
+from unittest import SkipTest
+
+from nose.tools import *
+
+import jsonselect
+from jsonselect import columns
+from jsonselect import jsonselect as js
+from tests.utils import jsonLoadOrdered
+
+
+DOC = '''
+{
+    "name": {"first": "Lloyd", "last": "Hilaiel"},
+    "favoriteColor": "yellow",
+    "languagesSpoken": [
+        {"lang": "Bulgarian", "level": "advanced"},
+        {"lang": "English", "level": "native", "preferred": true},
+        {"lang": "Spanish", "level": "beginner"}
+    ],
+    "seatingPreference": ["window", "aisle"],
+    "drinkPreference": ["whiskey", "beer", "wine"],
+    "weight": 172
+}'''
+
+
+def test_index():
+    obj = jsonLoadOrdered('{"a": [1, {"b": 2}], "b": null}')
+    doc = jsonselect.Document(obj)
+    eq_([1, 2, obj['a'][1], obj['a'], None, obj], doc.nodes)
+    eq_([3, 2, 3, 5, 5, None], doc.parents)
+    eq_([None, 'b', None, 'a', 'b', None], doc.keys)
+    eq_([0, None, 1, None, None, None], doc.nums)
+    eq_([2, None, 2, None, None, None], doc.tots)
+    eq_([1, 4], doc.by_key['b'])
+    eq_([0, 1], doc.by_type[js._NUMBER])
+    eq_([0, 2], doc.children[3])
+
+
+def test_same_as_match(engine='python'):
+    obj = jsonLoadOrdered(DOC)
+    doc = jsonselect.Document(obj, engine)
+    for sel in ['.lang', ':root > .name > .first', 'string', '*', ':root',
+                '.languagesSpoken > :nth-child(2)', ':last-child',
+                '.drinkPreference > :nth-last-child(1)', 'object:has(.preferred)',
+                '.languagesSpoken .lang:val("English")', 'number:expr(x > 100)',
+                'string ~ number', '!object > .preferred', '.name .first, .last',
+                '.languagesSpoken object .level', ':root > * > :first-child',
+                ':root > .languagesSpoken > * > .level', 'array string',
+                '.languagesSpoken :has(.preferred) ~ * > .lang', '.nothing',
+                'number:expr(x > 100 && x < 200)', ':expr(x <= 172 || x = 1)',
+                ':root .languagesSpoken > :nth-last-child(2n+1) .lang']:
+        expected = list(jsonselect.match(sel, obj))
+        actual = list(doc.match(sel))
+        eq_([id(v) for v in expected], [id(v) for v in actual], sel)
+
+    # compiled selectors work, too.
+    eq_(['Lloyd'], list(doc.match(jsonselect.compile('.first'))))
+
+
+def test_deep_documents():
+    depth = 10000
+    obj = {'a': 'b'}
+    for i in range(depth):
+        obj = {'c': obj}
+    doc = jsonselect.Document(obj)
+    eq_(['b'], list(doc.match('.c > .a')))
+    eq_(depth - 1, len(list(doc.match('.c .c'))))
+
+
+def test_numpy_engine():
+    if columns.numpy is None:
+        raise SkipTest('NumPy is not installed')
+    test_same_as_match('numpy')
+
+    # integers which floats can't hold exactly are still compared exactly.
+    big = 2 ** 64 + 1
+    doc = jsonselect.Document([big, 10 ** 400, 1.5], 'numpy')
+    eq_([big, 10 ** 400], list(doc.match(':expr(x > 18446744073709551616)')))
+    eq_([10 ** 400], list(doc.match(':expr(x > 1e300)')))
+    eq_([1.5], list(doc.match('number:expr(x < 2)')))
+
+    assert_raises(ValueError, jsonselect.Document, [], 'fortran')
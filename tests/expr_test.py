@@ -0,0 +1,38 @@
+from nose.tools import *
+
+import math
+
+from jsonselect.jsonselect import exprEval, exprParse, _compileExpr
+
+VALUES = [0, 1, 3, 2.5, -1, True, False, None, '', 'a', 'foo', 'oof', [], [1], {}, {'a': 1}]
+
+EXPRS = [
+    'x', 'x > 3 && x < 10', '3 < x', 'x <= "b"', '"b" >= x', 'x < true',
+    'x $= "o"', '"foo" $= x', 'x ^= "f"', 'x *= "o"', 'x *= 1',
+    'x = "foo"', 'x != 1', '1 + 2 * 3 = x', 'x * 2 > 5', 'x % 2 = 1',
+    '(x - 1) * 3', 'x + "a"', 'x || 1', 'x && x', 'null = x', '1 = 1', '"a" + 1'
+]
+
+
+def same(a, b):
+    if isinstance(a, float) and math.isnan(a):
+        return isinstance(b, float) and math.isnan(b)
+    return type(a) == type(b) and a == b
+
+
+def test_compiled_matches_eval():
+    for e in EXPRS:
+        tree = exprParse('(' + e + ')', 0)[1]
+        fn = _compileExpr(tree)
+        for x in VALUES:
+            expected = exprEval(tree, x)
+            actual = fn(x)
+            ok_(same(expected, actual), '%s with x=%r: %r != %r' % (e, x, expected, actual))
+
+
+def test_constant_folding():
+    fn = _compileExpr(exprParse('(1 + 2 * 3)', 0)[1])
+    eq_(7, fn(None))
+    # errors in constant sub-expressions surface at evaluation time, as before.
+    fn = _compileExpr(exprParse('(x = 1 / 0)', 0)[1])
+    assert_raises(ZeroDivisionError, fn, 1)
@@ -31,3 +31,285 @@ def test_Descendants():
 def test_Grouping():
     eq_([1, True, False, 3.1415], match("number,boolean", [ "a", 1, True, None, False, "b", 3.1415, "c" ] ))
     eq_([1, True, None, False, 3.1415], match("number,boolean,null", [ "a", 1, True, None, False, "b", 3.1415, "c" ] ))
+
+
+def test_deep_documents():
+    # deeper than the recursion limit.
+    depth = 10000
+    obj = [1]
+    for i in range(depth):
+        obj = [obj]
+    eq_([1], match("number", obj))
+    eq_(depth + 1, len(match("array", obj)))
+    eq_([obj], match(":root:has(number)", obj))
+
+    obj = {'a': 'b'}
+    for i in range(depth):
+        obj = {'c': obj}
+    eq_(['b'], match(".c > .a", obj))
+
+
+def test_has_memo():
+    obj = {'c': 0}
+    for i in range(100):
+        obj = {'b': obj}
+    eq_(101, len(match(":has(:has(.c))", obj)))
+
+    # each :has() search is run once per node.
+    ctx = jsonselect._Context()
+    sel = jsonselect.compile(".b:has(.c) .b")
+    eq_(99, len(list(jsonselect._forEach(sel._states, obj, ctx=ctx))))
+    eq_(100, len(ctx.has))
+
+
+def test_siblings():
+    eq_(["b"], match('number ~ string', [1, "b"]))
+    eq_(["b"], match('number ~ string', ["b", 1]))
+    eq_([], match('number ~ string', ["b", [1]]))
+    eq_([2], match('.a ~ .b', {'a': 1, 'b': 2}))
+    eq_([1, 2], match('number ~ number', [1, 2]))
+    # a simple selector repeated in the chain is only one sibling test.
+    eq_([], match('* ~ * ~ *', None))
+    eq_([3.5, {}], match('.a ~ .a ~ *', {'a': 3.5, 'c': {}}))
+    eq_([], match('.a ~ .a ~ .b', {'b': 1}))
+    eq_([1], match('.b ~ .b ~ .b', {'b': 1}))
+
+    obj = jsonLoadOrdered('{"x": {"a": 1, "b": 2}, "y": {"z": {"a": 3, "b": 4}}}')
+    eq_([2], match('.x > .a ~ .b', obj))
+    eq_([2, 4], match(':root .a ~ .b', obj))
+    eq_([4], match('.y .a ~ .b', obj))
+    eq_([2, 4], match('.y .a ~ .b, .x .a ~ .b', obj))
+    eq_([obj['x'], obj['y']['z'], obj['y'], obj],
+        match('object:has(.a ~ .b)', obj))
+
+    # "A ~ B ~ C": all of them are children of the same node.
+    eq_(["c"], match('number ~ null ~ string', [1, None, "c"]))
+    eq_([], match('number ~ null ~ string', [1, [None], "c"]))
+
+    # each container's children are only checked once.
+    arr = [1] + ['x'] * 10000
+    eq_(10000, len(match(':root > number ~ string', arr)))
+
+
+def test_subject():
+    obj = jsonLoadOrdered('''
+        {"a": {"b": 1, "c": {"a": {"b": 2}}}, "x": {"a": {"d": 3}}}''')
+    a1, a2, a3 = obj['a'], obj['a']['c']['a'], obj['x']['a']
+    eq_([a2, a1], match('!.a .b', obj))
+    eq_([a2, a1], match('!.a > .b', obj))
+    eq_([a1], match('!.a > .c', obj))
+    eq_([a2, a1, a3], match('!.a', obj))
+    eq_([a3], match('.x !.a', obj))
+    eq_([a3], match('.x !.a .d', obj))
+    eq_([a2, a1, a3], match('!.a .b, !.a .d', obj))
+    eq_([a2, obj['a']['c'], a1, obj], match('!object .b:val(2)', obj))
+
+    # :has() semantics: the rest of the selector may match the subject itself.
+    eq_(match('object', obj), match('!object object', obj))
+    eq_([1, 2, 3], match('!number number', obj))
+
+    eq_([1], match('!.b ~ .c', obj))
+    eq_([a1], match('!.a:has(.c) .b', obj))
+
+    assert_raises(jsonselect.JsonSelectError, match, '.a !', obj)
+    assert_raises(jsonselect.JsonSelectError, match, '! > .a', obj)
+
+
+def test_subject_bailout():
+    # bailout_fn prunes the search for .a, not the search below it for .c
+    obj = {'a': {'b': {'c': 1}}}
+    eq_([obj['a']],
+        list(jsonselect.match('!.a .c', obj, bailout_fn=lambda o, m: 'b' in o)))
+
+
+def test_key_lookup():
+    class Unlisted(dict):
+        def items(self):
+            raise AssertionError('should look keys up')
+        iteritems = items
+
+    obj = Unlisted(a=1, b=Unlisted(c=2), d=[{'a': 3}])
+    eq_([1], match(':root > .a', obj))
+    eq_([2], match(':root > .b > .c', obj))
+    eq_([], match(':root > .a > .a', obj))
+
+    # several keys come out in the dict's order.
+    obj = jsonLoadOrdered('{"z": 1, "y": 2, "x": 3}')
+    eq_([1, 3], match(':root > .x, :root > .z', obj))
+    eq_([1, 2, 3], match(':root > .y, :root > .x, :root > .z', obj))
+
+
+def test_nth_indices():
+    # the positions computed up front agree with testing every element.
+    for tot in range(8):
+        arr = list(range(tot))
+        for a in range(-3, 4):
+            for b in range(-4, 10):
+                for pf in ['nth-child', 'nth-last-child']:
+                    sel = jsonselect.compile(':root > :%s(%dn%+d)' % (pf, a, b))
+                    simple = sel._states.states[0].next.simple
+                    expected = [i for i in arr
+                                if simple.match(i, jsonselect._NUMBER, None,
+                                                i, tot, None)]
+                    eq_(expected, list(simple.indices(tot)))
+                    eq_(expected, match(sel, arr))
+
+    arr = list(range(100))
+    eq_([99], match(':root > :last-child', arr))
+    eq_([0, 1, 2, 97, 98, 99],
+        match(':root > :nth-child(-n+3), :root > :nth-last-child(-n+3)', arr))
+    eq_([], match(':root > :first-child', {'a': 1}))
+    # containers elsewhere in the array are still searched.
+    eq_([4, 2], match('.rows > :last-child', {'rows': [1, {'rows': [3, 4]}, 2]}))
+
+
+def test_match_many():
+    obj = jsonLoadOrdered('''
+        {"a": {"b": 1, "c": {"a": {"b": 2}}}, "x": [{"b": 3}, "s"]}''')
+    sels = [('b', '.b'), ('ab', '.a .b'), ('nums', 'number'),
+            ('strs', 'string, .x > :first-child'), ('none', '.z'),
+            ('has', 'object:has(.b:val(3))'), ('subj', '!.a > .c')]
+    pairs = list(jsonselect.match_many(sels, obj))
+    # the same values as separate match() calls, in the order of the document.
+    for name, sel in sels:
+        eq_(match(sel, obj), [v for n, v in pairs if n == name])
+    eq_(['b', 'ab', 'nums', 'b', 'ab', 'nums', 'b', 'nums', 'strs', 'has',
+         'strs', 'has', 'subj'], [n for n, v in pairs])
+
+    eq_([('n', 1)], list(jsonselect.match_many({'n': 'number'}, [1])))
+    eq_([], list(jsonselect.match_many({}, [1])))
+    assert_raises(jsonselect.JsonSelectError, list,
+                  jsonselect.match_many({'bad': '.a >'}, [1]))
+
+    # the tests the selectors have in common are only run once per node.
+    names, states, singles = jsonselect._compileMany(
+        (('a', '.foo .bar'), ('b', '.foo .baz'), ('c', '.foo')))
+    eq_(1, len(states.tests))
+
+
+def test_stats():
+    obj = jsonLoadOrdered('''
+        {"a": [{"name": "x", "v": 3}, {"v": 200}, {"name": "y"}],
+         "b": {"c": {"name": "z"}}}''')
+    stats = jsonselect.Stats()
+    eq_([200], list(jsonselect.match('.a .v:expr(x > 100)', obj, stats=stats)))
+    eq_(12, stats.nodes)
+    eq_({'.a': 12, '.v:expr(x > 100)': 7}, stats.tests)
+    eq_(2, stats.max_pending)
+    eq_(2, stats.expr_calls)
+    ok_(stats.expr_time > 0)
+
+    # counts add up over matches; :has() searches are counted separately.
+    eq_(5, len(list(jsonselect.match('object:has(.name)', obj,
+                                     stats=stats))))
+    eq_(19, stats.nodes)  # "object" only visits containers.
+    eq_(6, stats.has_searches)
+    eq_(15, stats.has_nodes)
+
+    # only the subtrees which the search would have entered count as pruned.
+    stats = jsonselect.Stats()
+    bail = lambda node, matched: isinstance(node, list)
+    eq_(['z'], list(jsonselect.match('.name', obj, bailout_fn=bail,
+                                     stats=stats)))
+    eq_(1, stats.pruned)
+    eq_(5, stats.nodes)
+
+
+def test_exists_count_first():
+    obj = jsonLoadOrdered('''
+        {"a": {"b": 1, "c": {"a": {"b": 2}}}, "x": [{"b": 3}, "s"]}''')
+    for sel in ['.b', '.a', 'string', '.z', '.a > .b', ':root', '!.a > .c']:
+        expected = match(sel, obj)
+        eq_(bool(expected), jsonselect.exists(sel, obj))
+        eq_(len(expected), jsonselect.count(sel, obj))
+
+    # first() is in document order, so an outer match comes before an inner
+    # one, though match() yields it after.
+    eq_(obj['a'], jsonselect.first('.a', obj))
+    eq_(obj['a']['c']['a'], match('.a', obj)[0])
+    eq_(1, jsonselect.first('.b', obj))
+    eq_(obj['a'], jsonselect.first('!.a > .c', obj))
+    # equal scalars elsewhere (which may be the same object) don't count.
+    rep = {'b': [2], 'c': {'a': {'c': 2}}}
+    ok_(jsonselect.first('!.c number', rep) is rep['c'])
+    eq_(None, jsonselect.first('.z', obj))
+    eq_('none', jsonselect.first('.z', obj, default='none'))
+    eq_(2, jsonselect.compile('number:expr(x > ?)', [1]).first(obj))
+
+    # exists() and first() don't look below a matching container, so they
+    # don't trip over an invalid value there; count() has to.
+    bad = {'a': [1, object()]}
+    ok_(jsonselect.exists('.a', bad))
+    eq_(bad['a'], jsonselect.first('.a', bad))
+    assert_raises(ValueError, jsonselect.count, '.a', bad)
+
+
+def test_analyze():
+    eq_((2, ((':root', False), ('.a', False), ('.b', False))),
+        jsonselect.compile(':root > .a > .b').analyze())
+    eq_((None, (('.a', True), ('.b', False))),
+        jsonselect.compile('.a > .b').analyze())
+    eq_(None, jsonselect.compile(':root > .a .b').analyze().max_depth)
+    eq_((('.b', True), ('.a', True)),
+        jsonselect.compile('.a ~ .b').analyze().fragments)
+
+
+def test_pruning():
+    obj = jsonLoadOrdered('''
+        {"a": {"b": [1, 2, {"c": 3}], "d": "x"}, "e": [{"b": [4]}, "y"]}''')
+
+    def skips(sel):
+        stats = jsonselect.Stats()
+        expected = match(sel, obj)
+        eq_(expected, list(jsonselect.match(sel, obj, stats=stats)))
+        return stats.skips
+
+    # the selector can't go any further below .b.
+    eq_({'depth': 1, 'keys': 2}, skips(':root > .a > .b'))
+    eq_({'keys': 2, 'positions': 1},
+        skips(':root > .a > .b > :first-child'))
+    # only the containers in an array can lead to a ".b" or ".c".
+    eq_({'keys': 3, 'scalars': 3}, skips('.b > .c, :root > .a'))
+    # "object" only has to visit the children which are containers.
+    eq_({'scalars': 7}, skips('object'))
+    bail = lambda node, matched: matched
+    stats = jsonselect.Stats()
+    list(jsonselect.match('.a', obj, bailout_fn=bail, stats=stats))
+    eq_(1, stats.skips['bailout'])
+    eq_(1, stats.pruned)
+
+
+def test_prune_options():
+    obj = jsonLoadOrdered('''
+        {"a": {"b": [1, 2, {"c": 3}], "d": "x"}, "e": [{"b": [4]}, "y"]}''')
+
+    def run(sel, **kwargs):
+        stats = jsonselect.Stats()
+        out = list(jsonselect.match(sel, obj, stats=stats, **kwargs))
+        return out, stats.skips
+
+    # .b itself still matches, but nothing below it is visited.
+    out, skips = run('number, .b', prune='.b')
+    eq_([[1, 2, {'c': 3}], [4]], out)
+    eq_(2, skips['prune'])
+    # the same as a bailout_fn which stops at the prune selector's matches.
+    bs = set(id(v) for v in jsonselect.match('.b', obj))
+    eq_(list(jsonselect.match('*', obj,
+                              bailout_fn=lambda node, m: id(node) in bs)),
+        list(jsonselect.match('*', obj, prune='.b')))
+
+    out, skips = run('number', max_depth=1)
+    eq_([], out)
+    out, skips = run('string', max_depth=2)
+    eq_(['x', 'y'], out)
+    eq_(2, skips['max_depth'])
+
+    out, skips = run('.b', prune_on_match=True)
+    eq_([[1, 2, {'c': 3}], [4]], out)
+    eq_(2, skips['prune_on_match'])
+    eq_(list(jsonselect.match('array', obj, bailout_fn=lambda n, m: m)),
+        list(jsonselect.match('array', obj, prune_on_match=True)))
+
+    # a subject in the prune selector is matched up front; here it's .a.
+    eq_([4, 'y'],
+        list(jsonselect.match('number, string', obj, prune='!.a > .b')))
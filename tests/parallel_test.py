@@ -0,0 +1,46 @@
+from nose.tools import *
+
+import jsonselect
+from tests.utils import jsonLoadOrdered
+
+
+def records(n):
+    return jsonLoadOrdered('{"type": "FeatureCollection", "features": [%s]}' %
+                           ', '.join('{"id": %d, "name": "n%d", "tags": ["a", %d]}'
+                                     % (i, i, i) for i in range(n)))
+
+
+def test_same_as_match():
+    obj = records(50)
+    for sel in ['.name', ':root > .features > * > .id', '.features > :last-child',
+                '.features > :nth-last-child(3n+1) > .id', ':root', 'string',
+                '.id ~ .name', '.features > object ~ object > .name',
+                'object:has(.id:expr(x > 40))', '!object > .name:val("n7")',
+                ':root > .type ~ .features > :first-child']:
+        expected = list(jsonselect.match(sel, obj))
+        for chunk_size in [1, 7, None]:
+            actual = list(jsonselect.parallel_match(sel, obj, workers=2,
+                                                    chunk_size=chunk_size))
+            eq_(expected, actual, (sel, chunk_size))
+            # the values are obj's own, not copies.
+            for a, b in zip(expected, actual):
+                ok_(a is b)
+
+
+def test_object_members():
+    obj = jsonLoadOrdered('{%s}' % ', '.join('"k%d": {"v": %d}' % (i, i)
+                                              for i in range(20)))
+    expected = list(jsonselect.match('.v', obj))
+    eq_(expected, list(jsonselect.parallel_match('.v', obj, workers=3,
+                                                 chunk_size=4)))
+
+
+def test_workers():
+    obj = records(3)
+    eq_(list(jsonselect.match('.name', obj)),
+        list(jsonselect.parallel_match('.name', obj, workers=1)))
+    # the arguments are checked when it's called, as for match().
+    assert_raises(ValueError, jsonselect.parallel_match, '.name', obj,
+                  workers=0)
+    assert_raises(jsonselect.jsonselect.JsonSelectError,
+                  jsonselect.parallel_match, '.name >', obj, workers=2)
@@ -60,3 +60,46 @@ def test_normalize():
     sel = [{'id': 'features'}, '>', {'subject': True}, {}, {'type': 'number'}]
     eq_([{'id': 'features'}, '>', {'has':[[{'type': 'number'}]]}],
         normalize(sel))
+
+
+def test_long_expressions():
+    # long expressions parse iteratively, with the usual precedence rules.
+    n = 2000
+    e = ':expr(' + ' && '.join(['x != %d' % i for i in range(n)]) + ')'
+    tree = parse(e)[1][0]['expr']
+    for i in reversed(range(1, n)):
+        eq_([Undefined, '!=', i], tree[2])
+        tree = tree[0]
+    eq_([Undefined, '!=', 0], tree)
+
+    eq_([Undefined, '||', [[1, '+', [2, '*', 3]], '=', Undefined]],
+        parse(':expr(x || 1 + 2 * 3 = x)')[1][0]['expr'])
+    eq_([[[Undefined, '-', 1], '-', 2], '*', 3],
+        parse(':expr((x - 1 - 2) * 3)')[1][0]['expr'])
+    eq_([Undefined, '=', None], parse(':expr(x = null)')[1][0]['expr'])
+
+
+def test_expression_errors():
+    with assert_raises(JsonSelectError) as context:
+        parse(':expr((x > 1)')
+    eq_("closing paren expected ')' in ':expr((x > 1)'", str(context.exception))
+
+    with assert_raises(JsonSelectError) as context:
+        parse(':expr(x x)')
+    eq_("binary operator expected in ':expr(x x)'", str(context.exception))
+
+    # a '(' after a value is read as an operator, as it always has been, so
+    # the errors after it are the ones reported.
+    with assert_raises(JsonSelectError) as context:
+        parse(':expr(x=1 ())')
+    eq_("expression expected in ':expr(x=1 ()) - )'", str(context.exception))
+
+    with assert_raises(JsonSelectError) as context:
+        parse(':expr(1)(x)')
+    eq_("unexpected closing paren in ')'", str(context.exception))
+
+    # ...and where there are none, the '(' is rejected, rather than when the
+    # selector is used.
+    with assert_raises(JsonSelectError) as context:
+        parse(':expr(x(1)')
+    eq_("binary operator expected in ':expr(x(1)'", str(context.exception))
@@ -0,0 +1,100 @@
+import io
+
+from nose.tools import *
+
+import jsonselect
+from tests.utils import jsonLoadOrdered
+
+
+DOC = '''
+{
+    "name": {"first": "Lloyd", "last": "Hilaiel"},
+    "favoriteColor": "yellow",
+    "languagesSpoken": [
+        {"lang": "Bulgarian", "level": "advanced"},
+        {"lang": "English", "level": "native", "preferred": true},
+        {"lang": "Spanish", "level": "beginner"}
+    ],
+    "seatingPreference": ["window", "aisle"],
+    "drinkPreference": ["whiskey", "beer", "wine"],
+    "weight": 172.5,
+    "escaped": "a \\"quoted\\" \\u00e9 string"
+}'''
+
+
+def stream(sel, text, chunk_size=65536):
+    return list(jsonselect.match_stream(sel, io.StringIO(u'%s' % text),
+                                        chunk_size=chunk_size))
+
+
+def test_same_as_match():
+    obj = jsonLoadOrdered(DOC)
+    for sel in ['.lang', ':root > .name > .first', 'string', '*', ':root',
+                '.languagesSpoken > :nth-child(2)', ':last-child',
+                '.drinkPreference > :nth-last-child(1)', 'object:has(.preferred)',
+                '.languagesSpoken .lang:val("English")', 'number:expr(x > 100)',
+                'string ~ number', '!object > .preferred', '.escaped',
+                ':root > .languagesSpoken > * > .level']:
+        expected = list(jsonselect.match(sel, obj))
+        for chunk_size in [1, 5, 65536]:
+            eq_(expected, stream(sel, DOC, chunk_size), sel)
+
+
+def test_bytes():
+    eq_([u'\xe9'], list(jsonselect.match_stream(
+        '.a', io.BytesIO(u'{"a": "\xe9"}'.encode('utf-8')), chunk_size=1)))
+
+
+def test_skipping():
+    # the unreachable parts aren't decoded.
+    eq_([1], stream(':root > .a', '{"b": [nonsense, {"a": 2}], "a": 1}'))
+    eq_([2], stream(':root > .b > *', '{"a": {"b": [nonsense]}, "b": [2]}'))
+
+
+def test_long_values():
+    # a container to load, and a string, which each span many chunks.
+    obj = {'a': [{'k%d' % i: [i, 'v' * (i % 7)]} for i in range(3000)],
+           'b': 'x' * 100000}
+    text = u'{"a": [%s], "b": "%s"}' % (
+        ', '.join('{"k%d": [%d, "%s"]}' % (i, i, 'v' * (i % 7))
+                  for i in range(3000)),
+        'x' * 100000)
+
+    class Counting(io.StringIO):
+        reads = 0
+
+        def read(self, size=-1):
+            Counting.reads += 1
+            return io.StringIO.read(self, size)
+
+    eq_([obj['a'], obj['b']],
+        list(jsonselect.match_stream(':root > array, :root > .b',
+                                     Counting(text), chunk_size=64)))
+    # the reads get longer as the values do, rather than each being a chunk.
+    ok_(Counting.reads < 100, Counting.reads)
+
+def test_errors():
+    for text in ['', '[1, 2', '{"a": 1,}', '[1 2]', '{"a" 1}', '[1] 2', 'nul']:
+        assert_raises(ValueError, stream, 'number', text)
+
+
+def test_exists_count_first():
+    obj = jsonLoadOrdered(DOC)
+    for sel in ['.lang', 'string', ':root', '.nope', 'object:has(.preferred)',
+                '!object > .preferred', ':last-child']:
+        expected = list(jsonselect.match(sel, obj))
+        for chunk_size in [1, 65536]:
+            f = lambda: io.StringIO(u'%s' % DOC)
+            eq_(bool(expected), jsonselect.exists_stream(sel, f(),
+                                                         chunk_size=chunk_size))
+            eq_(len(expected), jsonselect.count_stream(sel, f(),
+                                                       chunk_size=chunk_size))
+            eq_(jsonselect.first(sel, obj, default='none'),
+                jsonselect.first_stream(sel, f(), chunk_size=chunk_size,
+                                        default='none'))
+
+    # reading stops at the first match.
+    text = u'{"a": {"b": 1}, "c": [oops'
+    ok_(jsonselect.exists_stream('.b', io.StringIO(text)))
+    eq_({'b': 1}, jsonselect.first_stream('.a', io.StringIO(text)))
+    assert_raises(ValueError, jsonselect.count_stream, '.b', io.StringIO(text))